@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class ApplyEngine():
+    def __init__(self, logger, workers=1, backlog=4):
+        '''
+        Runs API operations on a bounded pool of worker threads.
+        logger - Logger for the summary
+        workers - number of operations in flight, 1 runs every operation
+                  inline in submission order like the sequential loops did
+        backlog - queued operations allowed per worker before submit() blocks,
+                  so a large plan is not materialized as futures all at once
+        Rate limiting is left to the NsxConnect the operations are sent with.
+        '''
+        self.logger = logger
+        self.workers = workers
+        self.pool = None
+        if workers > 1:
+            self.pool = ThreadPoolExecutor(max_workers=workers)
+            self.slots = threading.BoundedSemaphore(workers * backlog)
+        self.pending = []
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.start = None
+
+    def __run(self, fn, args, kwargs, timed=True):
+        if not timed:
+            return fn(*args, **kwargs)
+        start = time.time()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            with self.lock:
+                self.latencies.append(time.time() - start)
+
+    def measure(self, fn, *args, **kwargs):
+        '''
+        Run fn(*args, **kwargs) in the calling thread and count it as one
+        operation.  Used by jobs that send several operations in turn
+        '''
+        if self.start is None:
+            self.start = time.time()
+        return self.__run(fn, args, kwargs)
+
+    def __release(self, future):
+        self.slots.release()
+
+    def submit(self, fn, *args, **kwargs):
+        '''
+        Queue fn(*args, **kwargs), or run it now if there is only one worker
+        '''
+        self.__submit(fn, args, kwargs, True)
+
+    def submitJob(self, fn, *args, **kwargs):
+        '''
+        Like submit(), but fn is not timed as an operation itself, it is
+        expected to time its API calls with measure()
+        '''
+        self.__submit(fn, args, kwargs, False)
+
+    def __submit(self, fn, args, kwargs, timed):
+        if self.start is None:
+            self.start = time.time()
+        if not self.pool:
+            self.__run(fn, args, kwargs, timed)
+            return
+        self.slots.acquire()
+        future = self.pool.submit(self.__run, fn, args, kwargs, timed)
+        future.add_done_callback(self.__release)
+        self.pending.append(future)
+        if len(self.pending) >= self.workers * 64:
+            self.__collect()
+
+    def __collect(self):
+        # drop finished futures so a long run doesn't keep one per operation,
+        # raising their exceptions now rather than at the next barrier
+        pending = []
+        for future in self.pending:
+            if future.done():
+                future.result()
+            else:
+                pending.append(future)
+        self.pending = pending
+
+    def barrier(self):
+        '''
+        Wait for every submitted operation to finish.  Exceptions raised by
+        an operation, including the exit() from Logger errors, are re-raised
+        here in the calling thread
+        '''
+        pending = self.pending
+        self.pending = []
+        for future in pending:
+            future.result()
+
+    def close(self):
+        self.barrier()
+        if self.pool:
+            self.pool.shutdown()
+
+    def shutdown(self):
+        '''
+        Stop without starting queued operations, waits for the ones in flight
+        '''
+        if self.pool:
+            self.pool.shutdown(wait=True, cancel_futures=True)
+
+    def stats(self):
+        with self.lock:
+            latencies = sorted(self.latencies)
+        elapsed = time.time() - self.start if self.start else 0
+        result = {"ops": len(latencies), "seconds": elapsed,
+                  "ops_per_sec": len(latencies) / elapsed if elapsed else 0}
+        for p in [50, 90, 99]:
+            if latencies:
+                result["p%d" % p] = latencies[min(len(latencies)-1, len(latencies) * p // 100)]
+            else:
+                result["p%d" % p] = 0
+        result["max"] = latencies[-1] if latencies else 0
+        return result
+
+    def report(self):
+        s = self.stats()
+        msg = ("Applied %d operations with %d workers in %.1fs, %.1f ops/sec, latency p50 %.3fs p90 %.3fs p99 %.3fs max %.3fs"
+               %(s["ops"], self.workers, s["seconds"], s["ops_per_sec"],
+                 s["p50"], s["p90"], s["p99"], s["max"]))
+        self.logger.log(self.logger.INFO, msg)
+        print(msg)
+
+
+class ChunkSizer():
+    def __init__(self, size=1000, minimum=100, maximum=5000, target=2.0, step=None):
+        '''
+        Additive increase, multiplicative decrease size for chunked requests,
+        shared by the threads sending them.
+        size - starting chunk size
+        target - response time in seconds below which chunks grow by step
+                 (default a tenth of size).  Slower or throttled responses
+                 shrink the size by a quarter, failures and timeouts halve it
+        '''
+        self.current = size
+        self.minimum = min(minimum, size)
+        self.maximum = maximum
+        self.target = target
+        self.step = step if step else max(1, size // 10)
+        self.lock = threading.Lock()
+        self.smallest = size
+        self.largest = size
+
+    def size(self):
+        with self.lock:
+            return self.current
+
+    def update(self, size, latency, ok, throttled=False):
+        '''
+        Feedback for one request of size items
+        latency - seconds the request took, None if it timed out
+        ok - False if the request failed
+        throttled - True if NSX throttled requests while it was sent
+        '''
+        with self.lock:
+            if not ok or latency is None:
+                self.current = max(self.minimum, min(self.current, size) // 2)
+            elif throttled or latency > self.target:
+                self.current = max(self.minimum, self.current * 3 // 4)
+            elif size >= self.current:
+                # only full size chunks show the size is sustainable
+                self.current = min(self.maximum, self.current + self.step)
+            self.smallest = min(self.smallest, self.current)
+            self.largest = max(self.largest, self.current)
+
+    def stats(self):
+        with self.lock:
+            return {"size": self.current, "smallest": self.smallest, "largest": self.largest}
@@ -2,14 +2,21 @@
 import sys
 import csv
 import argparse
-from nsxconnect import NsxConnect
+from nsxconnect import NsxConnect, ResponseCache
 import getpass
 import ipaddress
 import uuid
 import copy
+import operator
 #from urllib.parse import quote as urlnormalize
 from logger import Logger
+from vmindex import VmIndex, VmRecord, VifRecord, ipBounds
+from inventory import NetworkInventory, InventorySnapshot
+from inventorystore import InventoryDb, VmStore, NetworkStore
+from searchindex import SearchVmIndex
 import json
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 
 class Tag():
@@ -39,19 +46,194 @@ class Tag():
     def getTags(self):
         return self.tags
 
+    def key(self, tag):
+        # hashable form of a tag for dictionary lookups
+        return tuple(sorted(tag.items()))
+
+
+class ScopeTags():
+    def __init__(self, value, multitag):
+        '''
+        VM tag operations for one tag scope.  Each record pairs the VMs a
+        tag is applied to with the VMs it will be removed from on rollback.
+        byTag - tag key to the positions of its records
+        byVm - VM external_id to the positions of records applying to it
+        '''
+        self.value = value
+        self.multitag = multitag
+        self.records = []
+        self.byTag = {}
+        self.byVm = {}
+
+    # A record's "apply" dictionary keeps VM ids in the order they were
+    # added, with constant time membership tests and deletes.
+    def __addRecord(self, tag, vmid):
+        record = {"tag": tag, "key": Tag().key(tag), "apply": {vmid: True}, "remove": [vmid],
+                  "same": None}
+        self.records.append(record)
+        pos = len(self.records) - 1
+        self.byTag.setdefault(record["key"], []).append(pos)
+        self.byVm.setdefault(vmid, set()).add(pos)
+
+    def __removeRecord(self, key, pos):
+        # the remove list has always been found by equality with the apply
+        # record, so an earlier record of the same tag with the same VMs in
+        # the same order gets it.  Records of a tag that are equal stay
+        # equal, add() appends and deletes the same VMs on both, so a match
+        # found once isn't compared again.
+        record = self.records[pos]
+        for other in self.byTag[key]:
+            if other == pos:
+                break
+            if other == record["same"]:
+                return self.records[other]
+            o = self.records[other]
+            # the same VMs in the same order, stopping at the first difference
+            if (len(o["apply"]) == len(record["apply"]) and
+                not any(map(operator.ne, o["apply"], record["apply"]))):
+                record["same"] = other
+                return o
+        return record
+
+    def add(self, vm, tag, logger):
+        '''
+        Apply tag to vm, taking it off any other tag of this scope
+        unless the scope allows multiple tags
+        '''
+        vmid = vm.external_id
+        key = Tag().key(tag)
+        found=False
+        for pos in self.byTag.get(key, []):
+            record = self.records[pos]
+            if vmid not in record["apply"]:
+                if tag in vm.tags:
+                    logger.info("*Not adding tag %s to vm %s because it already has original list:%s" %(tag, vm.display_name, vm.tags))
+                    continue
+                record["apply"][vmid] = True
+                self.__removeRecord(key, pos)["remove"].append(vmid)
+                self.byVm.setdefault(vmid, set()).add(pos)
+                found = True
+        if not self.multitag:
+            for pos in sorted(self.byVm.get(vmid, [])):
+                record = self.records[pos]
+                if record["key"] == key:
+                    continue
+                logger.warn("VM %s with ID %s being removed from %s by adding to %s because scope %s is not multitag allowed." %(vm.display_name, vmid, record["tag"], tag, tag["scope"]))
+                del record["apply"][vmid]
+                self.byVm[vmid].discard(pos)
+
+        if not found:
+            if tag in vm.tags:
+                logger.info("Not adding tag %s to vm %s because it already has original tags list:%s" %(tag, vm.display_name,vm.tags))
+            else:
+                checkmulti=False
+                if not self.multitag:
+                    for otag in vm.tags:
+                        if otag["scope"] == tag["scope"]:
+                            checkmulti=True
+                            logger.info("Not adding tag %s to VM %s because it already has non-multitag scope allowed tag: %s" %(tag, vm.display_name, vm.tags))
+                            break
+                if not checkmulti:
+                    self.__addRecord(copy.deepcopy(tag), vmid)
+
+    def toDict(self):
+        # here we expect scope["tags] to be a dictionary of NSX TagBulkOperation
+        #  
+        #  { "tag": tag,
+        #     "apply_to": [{"resource_type": "VirtualMachine", "resource_ids": []}]
+        #  }
+        #
+        # scope["tagremove"] would contain the opposite where we want to remove
+        # all the new tags that we've added to the VM
+        #  { "tag": tag,
+        #     "remove_from": [{"resource_type": "VirtualMachine", "resource_ids": []}]
+        #  }
+        scope={}
+        scope["value"] = self.value
+        scope["multitag"] = self.multitag
+        scope["tags"] = []
+        scope["tagsremove"] = []
+        for record in self.records:
+            scope["tags"].append({"tag": record["tag"],
+                                  "apply_to": [{"resource_type": "VirtualMachine",
+                                                "resource_ids": list(record["apply"])}]})
+            scope["tagsremove"].append({"tag": record["tag"],
+                                        "remove_from": [{"resource_type": "VirtualMachine",
+                                                         "resource_ids": record["remove"]}]})
+        return scope
+
+
+class PlanOutput():
+    def __init__(self):
+        '''
+        Everything grouptag.py writes to its JSON output, kept in keyed
+        structures while rows are processed.  toDict() gives the JSON layout.
+        groupIndex - group fingerprint to group, for updateGroups
+        vms, segments - url to API entry
+        scopes - scope name to ScopeTags
+        '''
+        self.groups = []
+        self.groupIndex = {}
+        self.vms = {}
+        self.segments = {}
+        self.scopeheader = []
+        self.scopes = {}
+
+    def addScope(self, value, multitag):
+        self.scopeheader.append(value)
+        self.scopes[value] = ScopeTags(value, multitag)
+
+    def toDict(self):
+        output={}
+        output["groups"] = self.groups
+        output["vms"] = list(self.vms.values())
+        output["segments"] = list(self.segments.values())
+        output["scopeheader"] = self.scopeheader
+        output["scopes"] = [self.scopes[v].toDict() for v in self.scopeheader]
+        return output
+
         
 def parseParameters():
     parser = argparse.ArgumentParser()
     parser.add_argument("-i", "--input", required=True, help="CSV input")
-    parser.add_argument("-n", "--nsx", required=True, help="NSX Manager")
+    parser.add_argument("-n", "--nsx", required=False,
+                        help="NSX Manager, not needed with --inventory")
     parser.add_argument("-u", "--user", required=False, default="admmin",
                         help="NSX user, defaults to admin")
     parser.add_argument("-p", "--password", required=False,
                         help="NSX user password")
     parser.add_argument("-o", "--output", required=True, help="JSON output file")
     parser.add_argument("-l", "--logfile", required=False, default="logfile.txt")
+    parser.add_argument("--netcache", required=False,
+                        help="Network inventory cache file, read if present and fresh, otherwise written")
+    parser.add_argument("--netcache-age", required=False, type=int, default=60,
+                        help="Maximum age in minutes of --netcache before it's reloaded, defaults to 60")
+    parser.add_argument("--workers", required=False, type=int, default=6,
+                        help="Number of inventory collections fetched concurrently, defaults to 6")
+    parser.add_argument("--page-size", required=False, type=int,
+                        help="Cursor page size for the VM and VIF downloads, defaults to the NSX default")
+    parser.add_argument("--rate", required=False, type=float,
+                        help="Maximum API requests per second sent to NSX, default no limit")
+    parser.add_argument("--save-inventory", required=False,
+                        help="Save the inventory downloaded from NSX to this file for later --inventory runs")
+    parser.add_argument("--inventory", required=False,
+                        help="Plan from an inventory file saved with --save-inventory, without connecting to NSX")
+    parser.add_argument("--response-cache", required=False,
+                        help="Directory to cache segment GET responses in, entries are re-used while their _revision is unchanged")
+    parser.add_argument("--response-cache-ttl", required=False, type=int, default=1440,
+                        help="Maximum age in minutes of --response-cache entries, defaults to 1440")
+    parser.add_argument("--response-cache-size", required=False, type=int, default=100000,
+                        help="Maximum number of --response-cache entries, least recently used are removed, defaults to 100000")
+    parser.add_argument("--inventory-db", required=False,
+                        help="Keep the inventory in this SQLite database instead of memory, recreated each run")
+    parser.add_argument("--search-threshold", required=False, type=int, default=25,
+                        help="CSVs with fewer rows to resolve to VMs than this are resolved with search queries instead of downloading every VM and VIF, 0 to always download, defaults to 25")
     
     args = parser.parse_args()
+    if not args.nsx and not args.inventory:
+        parser.error("one of --nsx or --inventory is required")
+    if args.inventory_db and args.save_inventory:
+        parser.error("--save-inventory is not supported with --inventory-db")
     return args
 
 def urlnormalize(name, logger):
@@ -70,16 +252,93 @@ def urlnormalize(name, logger):
     return newname
     
 
-def getAllVms(nsx):
-    vms = nsx.get(api="/policy/api/v1/infra/realized-state/virtual-machines",
-                  codes=[200], verbose=False,display=False)
+def getAllVms(nsx, page_size=None):
+    '''
+    VMs as VmRecord, projected as each page arrives so the full realized
+    state documents are not kept
+    '''
+    vms = {}
+    vms["results"] = [VmRecord.fromVm(vm) for vm in
+                      nsx.iterResults(api="/policy/api/v1/infra/realized-state/virtual-machines",
+                                      codes=[200], verbose=False, page_size=page_size)]
     return vms
 
-def getAllVifs(nsx):
-    vifs = nsx.get(api="/api/v1/fabric/vifs",
-                  codes=[200], verbose=False,display=False)
+def getAllVifs(nsx, page_size=None, logger=None):
+    vifs = {}
+    vifs["results"] = [VifRecord.fromVif(vif, logger) for vif in
+                       nsx.iterResults(api="/api/v1/fabric/vifs",
+                                       codes=[200], verbose=False, page_size=page_size)]
     return vifs
 
+def storeAllVms(nsx, store, page_size=None):
+    '''
+    Stream the VMs into VmStore store instead of a list, returns the count
+    '''
+    return store.addVms(nsx.iterResults(api="/policy/api/v1/infra/realized-state/virtual-machines",
+                                        codes=[200], verbose=False, page_size=page_size))
+
+def storeAllVifs(nsx, store, page_size=None):
+    return store.addVifs(nsx.iterResults(api="/api/v1/fabric/vifs",
+                                         codes=[200], verbose=False, page_size=page_size))
+
+def timedFetch(fetch, *args):
+    start = time.time()
+    result = fetch(*args)
+    return result, time.time() - start
+
+def bootstrapInventory(nsx, logger, workers=6, inventory=None, page_size=None, store=None):
+    '''
+    Fetch the VMs, VIFs, segments, Tier0s, Tier1s and segment ports
+    concurrently, logging how long each collection took.
+    inventory - NetworkInventory already loaded, e.g. from --netcache, only
+                the VMs and VIFs are fetched if provided
+    page_size - cursor page size for the VM and VIF downloads
+    store - optional VmStore, the VMs and VIFs are streamed into it and
+            the network inventory kept in its database
+    Returns the VMs, the VIFs and the NetworkInventory.  With store the
+    VM and VIF counts are returned instead of the lists
+    '''
+    start = time.time()
+    fetches = {}
+    if store:
+        fetches["vms"] = (storeAllVms, nsx, store, page_size)
+        fetches["vifs"] = (storeAllVifs, nsx, store, page_size)
+    else:
+        fetches["vms"] = (getAllVms, nsx, page_size)
+        fetches["vifs"] = (getAllVifs, nsx, page_size, logger)
+    if not inventory:
+        if store:
+            inventory = NetworkStore(nsx, logger, store.db)
+        else:
+            inventory = NetworkInventory(nsx, logger)
+        for objectType in NetworkInventory.searchTypes:
+            fetches[objectType] = (inventory.fetch, objectType)
+        fetches["segmentports"] = (inventory.fetchSegmentPorts,)
+
+    results = {}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {}
+        for name in fetches:
+            futures[name] = pool.submit(timedFetch, *fetches[name])
+        for name in fetches:
+            results[name], elapsed = futures[name].result()
+            if isinstance(results[name], int):
+                count = results[name]
+            elif isinstance(results[name], dict):
+                count = len(results[name]["results"])
+            else:
+                count = len(results[name])
+            logger.log(logger.INFO, "  fetched %d %s in %.1fs" %(count, name, elapsed))
+    logger.log(logger.INFO, "Inventory bootstrap of %d collections with %d workers took %.1fs"
+               %(len(fetches), workers, time.time() - start))
+
+    for objectType in NetworkInventory.searchTypes:
+        if objectType in results:
+            inventory.setObjects(objectType, results[objectType])
+    if "segmentports" in results:
+        inventory.setSegmentPorts(results["segmentports"])
+    return results["vms"], results["vifs"], inventory
+
 def findSegmentByIp(segments, iplist):
     found = []
     for s in segments:
@@ -113,12 +372,18 @@ def findSegmentByIp(segments, iplist):
     #    print("  " + i["path"])
     return found
 
-def findNsxNetwork(nsx, objectType, logger, operator, name=None, ip=None):
+def findNsxNetwork(nsx, objectType, logger, operator, name=None, ip=None, inventory=None):
     # operator can be startswith, endswith, contains, else match
+    # inventory - optional NetworkInventory, searched instead of querying NSX
     if objectType.lower() not in ["segment", "tier1", "tier0", "network"]:
-        logger.log(logger.WARN, "findNsxNetwork: unsupported type: "%objectType)
+        logger.log(logger.WARN, "findNsxNetwork: unsupported type: %s" %objectType)
         return []
-    if objectType.lower() == "network":
+    if inventory:
+        objs = {"results": inventory.getObjects(objectType.lower())}
+        if name and operator not in ["startswith", "endswith", "contains"]:
+            o = inventory.findByName(objectType.lower(), name)
+            return [o] if o else []
+    elif objectType.lower() == "network":
         objs = nsx.get(api="/policy/api/v1/search/query?query=resource_type:SEGMENT",
                        verbose=False)
     else:
@@ -152,53 +417,56 @@ def findNsxNetwork(nsx, objectType, logger, operator, name=None, ip=None):
 
     return []
                 
-def findSegmentAttachedVMs(nsx, segments, vms, logger):
+def findSegmentAttachedVMs(nsx, segments, vms, logger, ports=None, vmIndex=None):
+    '''
+    ports - optional segment path to ports map from getAllSegmentPorts,
+            avoids a GET of each segment's ports
+    vmIndex - optional VmIndex, used to look up the ports' VMs by
+              attachment id instead of scanning vms
+    '''
     vmlist=[]
+    ids=[]
     for segment in segments:
-        ports = nsx.get(api="/policy/api/v1%s/ports" % segment["path"], verbose=False)
+        if ports is not None:
+            segmentPorts = ports.get(segment["path"], [])
+        else:
+            segmentPorts = nsx.get(api="/policy/api/v1%s/ports" % segment["path"],
+                                   verbose=False)["results"]
             
-        for port in ports["results"]:
+        if vmIndex:
+            ids.extend(port["attachment"]["id"] for port in segmentPorts if "attachment" in port)
+            continue
+        for port in segmentPorts:
             if not "attachment" in port:
                 continue
             for vm in vms:
                 found=False
-                if not "attachments" in vm:
+                if vm.attachments is None:
                     continue
-                for a in vm["attachments"]:
-                    if not "lport_attachment_id" in a:
+                for a in vm.attachments:
+                    if a.lport_attachment_id is None:
                         continue
-                    if a["lport_attachment_id"] == port["attachment"]["id"]:
+                    if a.lport_attachment_id == port["attachment"]["id"]:
                         vmlist.append(vm)
                         found=True
                         break
                 if found:
                     break
+    if vmIndex:
+        # every segment's ports at once, so a search backed index can
+        # batch them
+        vmlist.extend(vm for vm in vmIndex.getByAttachments(ids) if vm)
     return vmlist
         
 def associateVifsToVms(vms, vifs, logger, progress=True):
     '''
-    Given list of VIFs and VMs, find each VIF's VM and update
-    the VM with the VIF attachment
+    Given list of VifRecords and VmRecords, find each VIF's VM and update
+    the VM with the VIF attachment.  Returns the VmIndex used for
+    the association so that later resolution stages can reuse it
     '''
-    if progress:
-        logger.log(logger.INFO, "Associating %d VIFs to %d VMs" %(len(vifs), len(vms)))
-    count = 0
-    for vif in vifs:
-        count+=1
-        if progress and count % 100 == 0:
-            logger.log(logger.INFO, "  Processed %d of %d VIFs" %(count, len(vifs)))
-        found=False
-        for vm in vms:
-            if vif["owner_vm_id"] == vm["external_id"]:
-                if "attachments" in vm.keys():
-                    vm["attachments"].append(vif)
-                else:
-                    vm["attachments"] = [vif]
-                found=True
-                break
-        if not found:
-            logger.log(logger.WARN, "VIF %d on VM UUID %d not found" %
-                  (vif["external_id"], vif["owner_vm_id"]))
+    vmIndex = VmIndex(vms, logger)
+    vmIndex.associateVifs(vifs, progress=progress)
+    return vmIndex
 
 def findHeaderIndex(header, sep, logger):
     try:
@@ -207,65 +475,80 @@ def findHeaderIndex(header, sep, logger):
         logger.log(logger.ERROR, "Header row from CSV has no seperator column labeled as '%s'" %sep)
         exit()
 
-def findOneVM(vms, name, ignorecase=True):
+def findOneVM(vms, name, ignorecase=True, index=None):
+    '''
+    The VM named name, the lowest external_id if the name is duplicated
+    '''
+    if index and ignorecase:
+        return index.findOne(name)
     if ignorecase:
         name=name.lower()
-    for vm in vms:
-        if vm["display_name"].lower() == name:
-            return [vm]
+    found = [vm for vm in vms if (vm.lower if ignorecase else vm.display_name) == name]
+    if found:
+        return [min(found, key=lambda vm: vm.external_id)]
     return []
 
-def findVMContains(vms, name, ignorecase=True):
+def findVMContains(vms, name, ignorecase=True, index=None):
+    if index and ignorecase:
+        return index.contains(name)
     if ignorecase:
         namelower=name.lower()
     found = []
     for vm in vms:
         if ignorecase:
-            if namelower in vm["display_name"].lower():
+            if namelower in vm.lower:
                 found.append(vm)
         else:
-            if name in vm["display_name"]:
+            if name in vm.display_name:
                 found.append(vm)
     return found
 
-def findVMsStartsWith(vms, name, ignorecase=True):
+def findVMsStartsWith(vms, name, ignorecase=True, index=None):
+    if index and ignorecase:
+        return index.startsWith(name)
     if ignorecase:
         namelower=name.lower()
     found = []
     for vm in vms:
         if ignorecase:
-            if vm["display_name"].lower().startswith(namelower):
+            if vm.lower.startswith(namelower):
                 found.append(vm)
         else:
-            if vm["display_name"].startswith(name):
+            if vm.display_name.startswith(name):
                 found.append(vm)
     return found
 
-def findVMsEndsWith(vms, name, ignorecase=True):
+def findVMsEndsWith(vms, name, ignorecase=True, index=None):
+    if index and ignorecase:
+        return index.endsWith(name)
     if ignorecase:
         namelower=name.lower()
     found = []
     for vm in vms:
         if ignorecase:
-            if vm["display_name"].lower().endswith(namelower):
+            if vm.lower.endswith(namelower):
                 found.append(vm)
         else:
-            if vm["display_name"].endswith(name):
+            if vm.display_name.endswith(name):
                 found.append(vm)
     return found
         
-def findVMsFromName(vms, name, matchtype):
+def findVMsFromName(vms, name, matchtype, index=None):
+    '''
+    index - optional vmindex.NameIndex built over vms, used instead of
+            scanning vms for case insensitive matches
+    '''
     name=name.strip()
     matchtype = matchtype.strip().lower()
 
     if matchtype == 'contains':
-        return findVMContains(vms, name)
+        return findVMContains(vms, name, index=index)
     elif matchtype == 'endswith':
-        return findVMsEndsWith(vms, name)
+        return findVMsEndsWith(vms, name, index=index)
     elif matchtype == 'startswith':
-        return findVMsStartsWith(vms, name)
+        return findVMsStartsWith(vms, name, index=index)
     else:
-        return findOneVM(vms, name)
+        return findOneVM(vms, name, index=index)
     return []
 
 def createExpressionFromTags(tags, mtype, logger, conjunction="AND"):
@@ -293,91 +576,108 @@ def createExpressionFromTags(tags, mtype, logger, conjunction="AND"):
 
     return expressions
 
-def updateSegments(segmentlist, segment, logger):
+def updateSegments(segments, segment, logger):
+    # segments - dictionary of segment API entries by url
     T = Tag()
-    for s in segmentlist:
-        if s["url"] == segment["url"]:
-            s["payload"]["tags"] = T.update(taglist=s["payload"]["tags"],
-                                            tags=segment["payload"]["tags"])
-            # found match, return
-            return segmentlist
+    if segment["url"] in segments:
+        s = segments[segment["url"]]
+        s["payload"]["tags"] = T.update(taglist=s["payload"]["tags"],
+                                        tags=segment["payload"]["tags"])
+        return segments
 
     #no match if this point reached
-    segmentlist.append(segment)
-    return segmentlist
+    segments[segment["url"]] = segment
+    return segments
 
-def updateVMs(vmlist, vm, logger):
+def updateVMs(vms, vm, logger):
+    # vms - dictionary of VM API entries by url
     T = Tag()
-    for v in vmlist:
-        if v["url"] == vm["url"]:
-            v["payload"]["tags"] = T.update(taglist=v["payload"]["tags"],
-                                            tags=vm["payload"]["tags"])
-            # found match, return
-            return vmlist
+    if vm["url"] in vms:
+        v = vms[vm["url"]]
+        v["payload"]["tags"] = T.update(taglist=v["payload"]["tags"],
+                                        tags=vm["payload"]["tags"])
+        return vms
 
     #no match if this point reached
-    vmlist.append(vm)
-    return vmlist
+    vms[vm["url"]] = vm
+    return vms
         
     
-def updateGroups(groups, newconfig, logger):
+def conditionFingerprint(expr):
+    return (expr["resource_type"], expr.get("key"), expr.get("member_type"),
+            expr.get("operator"), expr.get("scope_operator"), expr.get("value"))
+
+# expression types expressionFingerprint understands
+fingerprintTypes = ["IPAddressExpression", "PathExpression", "ExternalIDExpression",
+                    "NestedExpression", "Condition", "ConjunctionOperator"]
+
+def expressionFingerprint(expr, logger):
+    '''
+    Reduce one group expression to a hashable value that is the same for
+    equivalent expressions, regardless of the order of their members
+    '''
+    if expr["resource_type"] == "IPAddressExpression":
+        return (expr["resource_type"], tuple(sorted(expr["ip_addresses"])))
+    elif expr["resource_type"] == "PathExpression":
+        return (expr["resource_type"], tuple(sorted(expr["paths"])))
+    elif expr["resource_type"] == "ExternalIDExpression":
+        return (expr["resource_type"], expr["member_type"], tuple(sorted(expr["external_ids"])))
+    elif expr["resource_type"] == "NestedExpression":
+        return (expr["resource_type"],
+                tuple(sorted(conditionFingerprint(e) for e in expr["expressions"]
+                             if e["resource_type"] != "ConjunctionOperator")))
+    elif expr["resource_type"] == "Condition":
+        return conditionFingerprint(expr)
+    else:
+        logger.log(logger.ERROR, "Unexpected group type: %s" % expr)
+        exit(0)
+
+def groupFingerprint(group, logger):
+    '''
+    Canonical fingerprint of a group payload's expressions.  Top level
+    conjunctions are ignored since we only create "OR" at first level
+    '''
+    return tuple(expressionFingerprint(e, logger) for e in group["expression"]
+                 if e["resource_type"] != "ConjunctionOperator")
+
+def updateGroups(groups, newconfig, logger, index=None):
     # groups - list of all existing groups
     # newgroup - proposed new group
+    # index - fingerprint to group dictionary for groups, kept up to date here.
+    #   pass the same dictionary on every call, it's rebuilt from groups if None
     # determine if the definition of newgroup already exists as member of previously defined groups
     #   if not member, add to and return the new groups, otherwise, return groups
+    if index is None:
+        index = {}
+        for group in groups:
+            index.setdefault(groupFingerprint(group["payload"], logger), group)
 
-    # for this specifically, there should only be maximum of three non-conjunction expressions:
-    #     ipset, segmentpaths, nested tag list
-    for group in groups:
-        grp = group["payload"]
-        newgroup = newconfig["payload"]
-        if len(grp["expression"]) != len(newgroup["expression"]):
-            continue
-        match=False
-        for i in range(0,len(grp["expression"])):
-            if i%2 == 1:
-                # conjunctions are odd and we only create "OR" at first level
-                continue
-            else:
-                old=grp["expression"][i]
-                
-            for n in range(0, len(newgroup["expression"])):
-                if n%2 == 1:
-                    continue
-                else:
-                    newg = newgroup["expression"][n]
-                    
-                if old["resource_type"] != newg["resource_type"]:
-                    continue
-                if old["resource_type"] == "IPAddressExpression":
-                    if sorted(old["ip_addresses"]) == sorted(newg["ip_addresses"]):
-                        match = True
-                elif old["resource_type"] == "PathExpression":
-                    if sorted(old["paths"]) == sorted(newg["paths"]):
-                        match = True
-                elif old["resource_type"] == "NestedExpression":
-                    if compareTagExpressions(old["expressions"], newg["expressions"]):
-                        match = True
-                elif old["resource_type"] == "Condition":
-                    if old==newg:
-                        match = True
-                else:
-                    logger.log(logger.ERROR,
-                               "Unexpected group type: %s"
-                               % old)
-                    exit(0)
-                if not match:
-                    break
-            if not match:
-                break
-        if match:
-            # all the expressions match
-            return groups
-    # by this point, it means no match has been found
+    fingerprint = groupFingerprint(newconfig["payload"], logger)
+    if fingerprint in index:
+        # first definition wins
+        logger.log(logger.INFO, "Group %s from row %s collapsed into group %s"
+                   %(newconfig["payload"]["display_name"], newconfig.get("search"),
+                     index[fingerprint]["payload"]["display_name"]))
+        return groups
+    index[fingerprint] = newconfig
     groups.append(newconfig)
     return groups
                     
-def createSegmentGroup(nsx, segments, row, header, logger, output):
+def segmentTagPayload(segment, tags):
+    '''
+    PATCH body that only sets the tags of segment.  _revision is kept so
+    NSX rejects the update if the segment changed since it was read
+    '''
+    payload = {"resource_type": segment["resource_type"], "id": segment["id"],
+               "display_name": segment["display_name"], "tags": tags}
+    if "_revision" in segment:
+        payload["_revision"] = segment["_revision"]
+    return payload
+
+def createSegmentGroup(nsx, segments, row, header, logger, output, inventory=None):
+    '''
+    nsx - NsxConnect, None when planning offline from inventory
+    '''
     sgNameIndex = findHeaderIndex(header=header, sep="GroupName", logger=logger)
     scopeIndex = findHeaderIndex(header=header, sep="_SEP_", logger=logger) + 1
     tags=[]
@@ -451,17 +751,27 @@ def createSegmentGroup(nsx, segments, row, header, logger, output):
             # have to re-do GET api because the query searches for all segments with
             # return payloads that have consolidated status, and may not be complete
             # this now gets the complete object
-            realSegment=nsx.get(api="/policy/api/v1%s" %segment["path"], codes=[200],
-                                verbose=False, display=False)
+            if nsx:
+                # with --response-cache, a segment unchanged since the last run
+                # (same _revision as in the search result) isn't fetched again
+                realSegment=nsx.get(api="/policy/api/v1%s" %segment["path"], codes=[200],
+                                    verbose=False, display=False, cache=True,
+                                    revision=segment.get("_revision"),
+                                    modified=segment.get("_last_modified_time"))
+            else:
+                # offline, the search result carries the tags and _revision
+                # the tags-only patch needs
+                realSegment=copy.deepcopy(inventory.getByPath(segment["path"]))
             if not "tags" in realSegment:
                 realSegment["tags"] = []
             newtags = copy.deepcopy(realSegment["tags"])
             newtags = T.update(taglist=tags, tags=newtags)
             segmentapi={}
             segmentapi["url"] = "/policy/api/v1%s" % realSegment["path"]
+            segmentapi["path"] = realSegment["path"]
+            segmentapi["display_name"] = realSegment["display_name"]
             segmentapi["original_tags"] = realSegment["tags"]
-            realSegment["tags"] = newtags
-            segmentapi["payload"] = realSegment
+            segmentapi["payload"] = segmentTagPayload(realSegment, newtags)
             segmentapi["method"] = "patch"
             segmentapi["type"] = "segment"
             segmentapi["search"] = row
@@ -521,7 +831,7 @@ def createVMGroup(row, vmlist, header, logger, output):
         expr["member_type"] = "VirtualMachine"
         expr["external_ids"] = []
         for vm in vmlist:
-            expr["external_ids"].append(vm["external_id"])
+            expr["external_ids"].append(vm.external_id)
         group["expression"] = [expr]
         groupapi={}
         groupapi["url"] = "/policy/api/v1/infra/domains/default/groups/%s" % urlnormalize(group["display_name"], logger)
@@ -533,56 +843,10 @@ def createVMGroup(row, vmlist, header, logger, output):
 
     if len(tags) > 0:
         for vm in vmlist:
-            ntags = []
             for tag in tags:
-                ind = output["scopeheader"].index(tag["scope"])
-                if "tags" not in vm.keys():
-                    vm["tags"] = []
-
-                
-                if output["scopes"][ind]["value"] != tag["scope"]:
-                    logger.error("Output scope index has %s instead of %s" %(s["value"],
-                                                                             tag["scope"]))
-                multitag = output["scopes"][ind]["multitag"]
-                found=False
-                for s in output["scopes"][ind]["tags"]:
-                    if tag==s["tag"]:
-                        if vm["external_id"] not in s["apply_to"][0]["resource_ids"]:
-                            if tag in vm["tags"]:
-                                logger.info("*Not adding tag %s to vm %s because it already has original list:%s" %(tag, vm["display_name"], vm["tags"]))
-                                continue
-                            s["apply_to"][0]["resource_ids"].append(vm["external_id"])
-                            output["scopes"][ind]["tagsremove"][output["scopes"][ind]["tags"].index(s)]["remove_from"][0]["resource_ids"].append(vm["external_id"])
-                            found = True
-                    elif not multitag:
-                        if vm["external_id"] in s["apply_to"][0]["resource_ids"]:
-                            logger.warn("VM %s with ID %s being removed from %s by adding to %s because scope %s is not multitag allowed." %(vm["display_name"], vm["external_id"], s["tag"], tag, tag["scope"]))
-                            s["apply_to"][0]["resource_ids"].remove(vm["external_id"])
-
-                            
-                if not found:
-                    if tag in vm["tags"]:
-                        logger.info("Not adding tag %s to vm %s because it already has original tags list:%s" %(tag, vm["display_name"],vm["tags"]))
-                        
-                    else:
-                        checkmulti=False
-                        if not multitag:
-                            for otag in vm["tags"]:
-                                if otag["scope"] == tag["scope"]:
-                                    checkmulti=True
-                                    logger.info("Not adding tag %s to VM %s because it already has non-multitag scope allowed tag: %s" %(tag, vm["display_name"], vm["tags"]))
-                                    break
-                        if not checkmulti:
-                            newtag = {}
-                            newtag["tag"] = copy.deepcopy(tag)
-                            newtag["apply_to"] = [{"resource_type": "VirtualMachine",
-                                                   "resource_ids": [vm["external_id"]]}]
-                            output["scopes"][ind]["tags"].append(newtag)
-                            rtag={}
-                            rtag["tag"] = newtag["tag"]
-                            rtag["remove_from"] = [{"resource_type": "VirtualMachine",
-                                                    "resource_ids": [vm["external_id"]]}]
-                            output["scopes"][ind]["tagsremove"].append(rtag)
+                if tag["scope"] not in output.scopes:
+                    logger.error("Output has no scope %s" %tag["scope"])
+                output.scopes[tag["scope"]].add(vm, tag, logger)
             
     return apis
         
@@ -683,104 +947,71 @@ def validateIP(inputstr, logger, allowCIDRrange=False):
                 
     return iplist
 
-def findVMsWithIP(vmlist, iplist, logger):
+def findVMsWithIP(vmlist, iplist, logger, index=None):
+    '''
+    index - optional vmindex.IpIndex built over vmlist, answers each
+            IP, CIDR and RANGE with a bisect range query instead of a scan
+    '''
     vms=[]
     for ip in iplist:
-        if ip["type"] == "RANGE":
-            for vm in vmlist:
-                matched=False
-                if not "attachments" in vm:
-                    continue
-                for vif in vm["attachments"]:
-                    for addrinfo in vif["ip_address_info"]:
-                        if not "ip_addresses" in addrinfo:
-                            break
-                        for addr in addrinfo["ip_addresses"]:
-                            iptmp = ipaddress.ip_address(addr)
-                            if iptmp.is_loopback:
-                                continue
-                            if iptmp.version != ip["first"].version:
-                                continue
-                            if iptmp >= ip["first"] and iptmp <= ip["second"]:
-                                matched=True
-                                vms.append(vm)
-                                #addr loop
-                                break
-                            
-                        if matched:
-                            # attachments  loop
-                            break
-                    if matched:
-                        # vif loop
-                        break
-        elif ip["type"] == "CIDR":
-            for vm in vmlist:
-                matched=False
-                if not "attachments" in vm:
-                    continue
-                for vif in vm["attachments"]:
-                    for addrinfo in vif["ip_address_info"]:
-                        if not "ip_addresses" in addrinfo:
-                            break
-                        for addr in addrinfo["ip_addresses"]:
-                            iptmp = ipaddress.ip_address(addr)
-                            if iptmp.is_loopback:
-                                continue
-                            if iptmp.version != ip["cidr"].version:
-                                continue
-                            if iptmp in ip["cidr"].hosts():
-                                matched=True
-                                vms.append(vm)
-                                break
-                        if matched:
-                            # attachments  loop
-                            break
-                    if matched:
-                        # vif loop
-                        break
-        elif ip["type"] == "IP":
+        if index:
+            vms.extend(index.find(ip))
+        else:
+            # each VM once, on its first address in the range, like the
+            # old per-type scans; addresses are pre-parsed to integers
+            bounds = ipBounds(ip)
+            if not bounds:
+                continue
+            version, first, last = bounds
             for vm in vmlist:
-                matched=False
-                if not "attachments" in vm:
+                if vm.attachments is None:
                     continue
-                for vif in vm["attachments"]:
-                    for addrinfo in vif["ip_address_info"]:
-                        if not "ip_addresses" in addrinfo:
-                            break
-                        for addr in addrinfo["ip_addresses"]:
-                            iptmp = ipaddress.ip_address(addr)
-                            if iptmp.is_loopback:
-                                continue
-                            if iptmp.version != ip["ip"].version:
-                                continue
-                            if iptmp == ip["ip"]:
-                                matched=True
-                                vms.append(vm)
-                                break
-                        if matched:
-                            # attachments  loop
-                            break
-                    if matched:
-                        # vif loop
+                for vif in vm.attachments:
+                    if any(v == version and first <= value <= last
+                           for v, value in vif.addresses):
+                        vms.append(vm)
                         break
 
     return vms
-def compareTagExpressions(src, dst):
-    oldlist=[]
-    newlist=[]
-    for i in src:
-        if i["resource_type"] != "ConjunctionOperator":
-            oldlist.append(i)
-    for i in dst:
-        if i["resource_type"] != "ConjunctionOperator":
-            newlist.append(i)
-    if sorted(oldlist, key=lambda x: x["value"]) == sorted(newlist, key = lambda y: y["value"]):
-        return True
-    else:
-        return False
 
-                            
-def associateGroups(nsx, header, multitag, data, vms, logger, outfile):
+def resolutionStrategy(header, data, threshold, logger):
+    '''
+    Choose how the VMs of the CSV rows are found.  If fewer than threshold
+    rows resolve to VMs and none resolves IP addresses, returns the (name,
+    match type) of each VM row, to be searched for.  Otherwise returns None,
+    the whole VM and VIF inventory is downloaded
+    '''
+    nameIndex = findHeaderIndex(header=header, sep="Name", logger=logger)
+    matchIndex = findHeaderIndex(header=header, sep="Match", logger=logger)
+    resolveIndex = findHeaderIndex(header=header, sep="Resolve", logger=logger)
+    objIndex = findHeaderIndex(header=header, sep="ObjectType", logger=logger)
+    names = []
+    resolved = 0
+    ips = 0
+    for row in data:
+        objectType = row[objIndex].strip().lower()
+        if objectType == "vm":
+            names.append((row[nameIndex], row[matchIndex]))
+        elif objectType != "network" and row[resolveIndex].strip().lower() == "true":
+            if objectType == "ip":
+                ips+=1
+            else:
+                resolved+=1
+    rows = len(names) + resolved + ips
+    if ips or rows >= threshold:
+        logger.log(logger.INFO, "Resolution strategy: full inventory, %d rows to resolve, %d by IP address (search threshold %d)"
+                   %(rows, ips, threshold))
+        return None
+    logger.log(logger.INFO, "Resolution strategy: search, %d rows to resolve (search threshold %d)"
+               %(rows, threshold))
+    return names
+
+def associateGroups(nsx, header, multitag, data, vms, logger, outfile, vmIndex=None,
+                    inventory=None, searchPorts=False):
+    '''
+    searchPorts - if True, the ports of matched segments are searched for
+                  with vmIndex instead of reading every segment port
+    '''
     scopeIndex = findHeaderIndex(header=header, sep="_SEP_", logger=logger) + 1
     nameIndex = findHeaderIndex(header=header, sep="Name", logger=logger)
     matchIndex = findHeaderIndex(header=header, sep="Match", logger=logger)
@@ -788,37 +1019,14 @@ def associateGroups(nsx, header, multitag, data, vms, logger, outfile):
     sgNameIndex = findHeaderIndex(header=header, sep="GroupName", logger=logger)
     objIndex = findHeaderIndex(header=header, sep="ObjectType", logger=logger)
 
-    output={}
-    output["groups"] = []
-    output["vms"] = []
-    output["segments"] = []
-    output["scopeheader"] = []
-    output["scopes"] = []
+    output = PlanOutput()
     for i in range(scopeIndex, len(header)):
-        scope={}
-        scope["value"] = header[i].strip()
-        if scope["value"] in multitag:
-            scope["multitag"] = True
-        else:
-            scope["multitag"] = False
+        value = header[i].strip()
+        output.addScope(value, value in multitag)
 
-        scope["tags"] = []
-        scope["tagsremove"] = []
-        output["scopes"].append(scope)
-        output["scopeheader"].append(scope["value"])
-        # here we expect scope["tags] to be a dictionary of NSX TagBulkOperation
-        #  
-        #  { "tag": tag,
-        #     "apply_to": [{"resource_type": "VirtualMachine", "resource_ids": []}]
-        #  }
-        #
-        # scope["tagremove"] would contain the opposite where we want to remove
-        # all the new tags that we've added to the VM
-        #  { "tag": tag,
-        #     "remove_from": [{"resource_type": "VirtualMachine", "resource_ids": []}]
-        #  }
+    if not vmIndex:
+        vmIndex = VmIndex(vms, logger)
 
-        
     T = Tag()
     totalVMs=0
     totalIPs=0
@@ -836,14 +1044,17 @@ def associateGroups(nsx, header, multitag, data, vms, logger, outfile):
                            ("IP specifier %s resulted in no valid IPs" % row(nameIndex)))
                 exit()
             if row[resolveIndex].strip().lower() == 'true':
-                vmlist = findVMsWithIP(vms, ips, logger)
+                # the index answers the query, the attached VMs aren't
+                # listed since the SQLite store would read all of them
+                vmlist = findVMsWithIP([], ips, logger, index=vmIndex.ipIndex())
             else:
                 resolve=False
                 newgroup = createIPGroup(nsx=nsx, name=row[sgNameIndex],
                                             ips=ips, logger=logger)
         elif row[objIndex].strip().lower() == "vm":
             totalVMs+=1
-            vmlist = findVMsFromName(vms, row[nameIndex], row[matchIndex])
+            vmlist = findVMsFromName(vms, row[nameIndex], row[matchIndex],
+                                     index=vmIndex.nameIndex())
             if len(vmlist) == 0:
                 logger.log(logger.INFO, "VM not found: %s" %row[nameIndex])
         else:
@@ -851,62 +1062,53 @@ def associateGroups(nsx, header, multitag, data, vms, logger, outfile):
                 logger.log(logger.ERROR, "Don't have handler for type %s" %row[objIndex])
                 exit()
             totalNets+=1
+            if not inventory:
+                # only downloaded if the CSV has network rows
+                inventory = NetworkInventory(nsx, logger).load()
             if row[objIndex].strip().lower() == "segment":
                 segments.extend(findNsxNetwork(nsx=nsx, objectType="segment",
                                           logger=logger,
                                           operator=row[matchIndex].strip().lower(),
-                                          name=row[nameIndex].strip()))
+                                          name=row[nameIndex].strip(),
+                                          inventory=inventory))
             elif row[objIndex].strip().lower() == "network":
                 segments.extend(findNsxNetwork(nsx=nsx, objectType="network",
                                                logger=logger,
                                                operator=row[matchIndex].strip().lower(),
                                                name=None,
-                                               ip=row[nameIndex].strip()))
+                                               ip=row[nameIndex].strip(),
+                                               inventory=inventory))
             else:
                 gw = findNsxNetwork(nsx=nsx, objectType=row[objIndex].strip().lower(),
                                     operator=row[matchIndex].strip().lower(),
                                     name=row[nameIndex].strip(),
-                                    logger=logger)
+                                    logger=logger,
+                                    inventory=inventory)
                 if not gw:
                     logger.log(logger.WARN, "Gateway %s not found" %row[nameIndex])
                     continue
                 else:
                     gw=gw[0]
 
-                allsegments = findNsxNetwork(nsx=nsx, objectType="segment",
-                                             operator=row[matchIndex].strip().lower(),
-                                             name=None, logger=logger)
-                for segment in allsegments:
-                    if "connectivity_path" not in segment:
-                        continue
-                    
-                    if segment["connectivity_path"] == gw["path"]:
-                        segments.append(segment)
-
-                if gw["resource_type"] == "Tier0":
-                    tier1s = findNsxNetwork(nsx=nsx, objectType="tier1", name=None,
-                                            logger=logger,
-                                            operator=row[matchIndex].strip().lower())
-                    for t1 in tier1s:
-                        if "tier0_path" in t1 and t1["tier0_path"] == gw["path"]:
-                            for segment in allsegments:
-                                if "connectivity_path" not in segment:
-                                    continue
-                                if segment["connectivity_path"] == t1["path"]:
-                                    segments.append(segment)
-
+                segments.extend(inventory.getGatewaySegments(gw))
 
             if row[objIndex].strip().lower() !="network" and row[resolveIndex].strip().lower() == "true":
-                vmlist = findSegmentAttachedVMs(nsx, segments, vms, logger)
+                vmlist = findSegmentAttachedVMs(nsx, segments, [], logger,
+                                                ports=vmIndex.getSegmentPorts([s["path"] for s in segments])
+                                                      if searchPorts else inventory.getSegmentPorts(),
+                                                vmIndex=vmIndex)
             else:
                 resolve=False
                 newgroup = createSegmentGroup(nsx=nsx, segments=segments, row=row,
                                               header=header, output=output,
-                                              logger=logger)
+                                              logger=logger, inventory=inventory)
 
         #logger.info("Input: %s, vm matches: %d segmentmatches: %d, resolve: %s"
         #           %(row[nameIndex], len(vmlist), len(segments), row[resolveIndex]))
         if vmlist:
+            # the inventory, the SQLite store and search results each
+            # return VMs in their own order, the plan lists them by id
+            vmlist = sorted(vmlist, key=lambda vm: vm.external_id)
             newgroup.extend(createVMGroup(row, vmlist, header, logger, output))
         
         if newgroup:
@@ -916,21 +1118,22 @@ def associateGroups(nsx, header, multitag, data, vms, logger, outfile):
                         if e["resource_type"] == "NestedExpression" and len(e["expressions"]) == 0:
                             logger.log(logger.INFO, "newgroup: %s" %i)
                             logger.log(logger.ERROR, "no tags: %s" % row)
-                    output["groups"] = updateGroups(output["groups"], i, logger)
+                    output.groups = updateGroups(output.groups, i, logger,
+                                                 index=output.groupIndex)
                 elif i["type"] == "segment":
-                    output["segments"] = updateSegments(output["segments"], i, logger)
+                    output.segments = updateSegments(output.segments, i, logger)
                 elif i["type"] == "vm":
-                    output["vms"] = updateVMs(output["vms"], i, logger)
+                    output.vms = updateVMs(output.vms, i, logger)
 
     #nsx.jsonPrint(output, stdout=True)
     with open(outfile, "w") as fp:
-        fp.write(json.dumps(output, indent=4))
+        fp.write(json.dumps(output.toDict(), indent=4))
         fp.close()
     logger.log(logger.INFO, "Totals proccessed: VMs - %d, IPs - %d, Nets - %d" %(totalVMs, totalIPs, totalNets))
 def main():
     args = parseParameters()
     logger = Logger(args.logfile)
-    if not args.password:
+    if not args.password and not args.inventory:
         args.password = getpass.getpass("NSX Manager %s password: " %args.nsx)
     with open(args.input, 'r', newline='') as fp:
         csvreader = csv.reader(fp)
@@ -958,18 +1161,84 @@ def main():
         logger.log(logger.ERROR, "No header row found in CSV")
         return
 
-    nsx = NsxConnect(server=args.nsx, user=args.user,
-                     password=args.password, logger=logger)
-    nsxVms = getAllVms(nsx)
-    nsxVifs = getAllVifs(nsx)
-    associateVifsToVms(nsxVms["results"], nsxVifs["results"], logger)
+    store = None
+    search = None
+    if args.inventory_db:
+        store = VmStore(InventoryDb(args.inventory_db, logger), logger)
+    if args.inventory:
+        if store:
+            # streamed into the database, networks included
+            snapshot = InventorySnapshot(logger).loadInto(args.inventory, store,
+                                                          NetworkStore(None, logger, store.db))
+        else:
+            snapshot = InventorySnapshot(logger).load(args.inventory)
+            nsxVms = {"results": [VmRecord.fromVm(vm) for vm in snapshot.vms]}
+            nsxVifs = {"results": [VifRecord.fromVif(vif, logger) for vif in snapshot.vifs]}
+        if args.nsx and args.nsx != snapshot.manager:
+            logger.log(logger.WARN, "Inventory %s was taken from %s, not %s"
+                       %(args.inventory, snapshot.manager, args.nsx))
+        nsx = None
+        inventory = snapshot.inventory
+    else:
+        cache = None
+        if args.response_cache:
+            cache = ResponseCache(args.response_cache, ttl=args.response_cache_ttl*60,
+                                  maxentries=args.response_cache_size)
+        nsx = NsxConnect(server=args.nsx, user=args.user,
+                         password=args.password, logger=logger, rate_limit=args.rate,
+                         pool_maxsize=max(10, args.workers*2), cache=cache)
+        startRequests = nsx.getThrottleStats()["requests"]
+        if not store and not args.save_inventory:
+            search = resolutionStrategy(header, vmRows, args.search_threshold, logger)
+        inventory = None
+        cached = False
+        if args.netcache:
+            if store:
+                inventory = NetworkStore(nsx, logger, store.db)
+            else:
+                inventory = NetworkInventory(nsx, logger)
+            cached = inventory.loadFile(args.netcache, maxage=args.netcache_age*60)
+            if not cached:
+                inventory = None
+
+        if search is not None:
+            # the network inventory is read as network rows need it, and
+            # not written to --netcache as it has no segment ports
+            vmIndex = SearchVmIndex(nsx, logger, workers=args.workers, page_size=args.page_size)
+            vmIndex.prefetch(search)
+        else:
+            nsxVms, nsxVifs, inventory = bootstrapInventory(nsx, logger, workers=args.workers,
+                                                            inventory=inventory,
+                                                            page_size=args.page_size, store=store)
+        if args.netcache and not cached and search is None:
+            inventory.save(args.netcache)
+        if args.save_inventory:
+            # before associateVifsToVms adds the attachments to the VMs
+            InventorySnapshot(logger, manager=args.nsx, vms=nsxVms["results"],
+                              vifs=nsxVifs["results"], inventory=inventory).save(args.save_inventory)
+    if search is not None:
+        vms = []
+    elif store:
+        store.associateVifs()
+        vmIndex = store
+        vms = []
+    else:
+        vmIndex = associateVifsToVms(nsxVms["results"], nsxVifs["results"], logger)
+        vms = nsxVms["results"]
     
-    for vm in nsxVms["results"]:
-        #nsx.jsonPrint(vm)
-        pass
-        
     # header[3] is first tag scope
-    groups=associateGroups(nsx, header, multitag, vmRows, nsxVms['results'], logger, args.output)
+    groups=associateGroups(nsx, header, multitag, vmRows, vms, logger, args.output,
+                           vmIndex=vmIndex, inventory=inventory, searchPorts=search is not None)
+    if search is not None:
+        logger.log(logger.INFO, "Resolved with %d search queries, %d API calls"
+                   %(vmIndex.queries, nsx.getThrottleStats()["requests"] - startRequests))
+    elif nsx:
+        logger.log(logger.INFO, "Resolved from the full inventory with %d API calls"
+                   %(nsx.getThrottleStats()["requests"] - startRequests))
+    if nsx:
+        logger.log(logger.INFO, "API requests: %s" %nsx.getThrottleStats())
+    if nsx and nsx.cache:
+        logger.log(logger.INFO, "Response cache: %s" %nsx.cache.stats())
     
 if __name__ == "__main__":
     main()
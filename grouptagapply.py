@@ -9,7 +9,14 @@ import uuid
 import copy
 from datetime import datetime
 import json
+import time
+import requests
+from concurrent.futures import ThreadPoolExecutor
 from logger import Logger
+from applyengine import ApplyEngine, ChunkSizer
+from journal import Journal
+from planreader import PlanReader
+from grouptag import groupFingerprint, fingerprintTypes
 
 def parseParameters():
     parser = argparse.ArgumentParser()
@@ -30,6 +37,28 @@ def parseParameters():
                         help="If -r is specified, file containing list of --vms tags, --segment tags, or groups to removed")
     parser.add_argument("--trial", action="store_true",
                         help="If specified, will not send updates to NSX, just print")
+    parser.add_argument("--rate", required=False, type=float,
+                        help="Maximum API requests per second sent to NSX, default no limit")
+    parser.add_argument("--batch-size", required=False, type=int, default=0,
+                        help="Groups per hierarchical PATCH /policy/api/v1/infra request, default 0 sends one request per group")
+    parser.add_argument("--batch-segments", action="store_true",
+                        help="With --batch-size, also send segment tag updates in hierarchical requests")
+    parser.add_argument("--force", action="store_true",
+                        help="Send every group in the input, even the ones already configured the same way on NSX")
+    parser.add_argument("--workers", required=False, type=int, default=1,
+                        help="Number of API requests in flight, defaults to 1")
+    parser.add_argument("--ordered", action="store_true",
+                        help="With --mode all and --workers, finish the groups before starting tag operations")
+    parser.add_argument("--tag-batch", required=False, type=int, default=1000,
+                        help="Starting number of VMs per tag operation, adjusted to NSX response times, defaults to 1000")
+    parser.add_argument("--wait-realization", required=False, type=int, default=0,
+                        help="Seconds to wait for VM tag operations to be realized, default 0 does not wait")
+    parser.add_argument("--timeout", required=False, type=float, default=None,
+                        help="Seconds to wait for each NSX response, a timed out tag operation is retried with fewer VMs, default waits forever")
+    parser.add_argument("--journal", required=False,
+                        help="File recording completed operations, defaults to the input file name with .journal appended")
+    parser.add_argument("--resume", action="store_true",
+                        help="Skip the operations recorded as completed in the journal by a previous run")
 
     args = parser.parse_args()
     if args.globalmanager and args.mode != "group":
@@ -46,67 +75,493 @@ def filterObject(obj, rfilter):
         return False
         
 
-def applyGroup(nsx, groups, remove, rfilter, trial=False):
+def childGroups(groups, remove=False):
+    '''
+    Infra children for a list of group entries from the plan, one
+    ChildDomain per domain holding a ChildGroup for each group
+    '''
+    domains = {}
     for group in groups:
-        if not remove:
-            if group["method"] == "patch":
-                nsx.patch(api=group["url"], data=group["payload"],
-                          verbose=True, codes=[200], trial=trial)
+        # url is /policy/api/v1/infra/domains/<domain>/groups/<id>
+        path = group["url"].rstrip("/").split("/")
+        child = {"resource_type": "ChildGroup"}
+        if remove:
+            child["marked_for_delete"] = True
+            child["Group"] = {"resource_type": "Group", "id": path[-1]}
         else:
-            action = True
-            if rfilter and group["display_name"] in rfilter:
-                action=True
-            else:
-                action=False
-            if action:
-                nsx.delete(api=group["url"], verbose=True, codes=[200, 201], trial=trial)    
+            child["Group"] = dict(group["payload"], resource_type="Group", id=path[-1])
+        if path[-3] in domains:
+            domains[path[-3]].append(child)
+        else:
+            domains[path[-3]] = [child]
+    return [{"resource_type": "ChildDomain",
+             "Domain": {"resource_type": "Domain", "id": d, "children": domains[d]}}
+            for d in domains]
 
-def applySegmentTags(nsx, segments, remove, rfilter, trial=False):
+def segmentPayload(segment):
+    '''
+    Tags-only PATCH body for a segment entry.  Plans written by older
+    versions of grouptag.py carry the whole segment in the payload
+    '''
+    payload = segment["payload"]
+    body = {k: payload[k] for k in ["resource_type", "id", "display_name", "_revision"]
+            if k in payload}
+    body["tags"] = payload["tags"]
+    return body
+
+def infraSegment(segment):
+    # infra and tier-1 segments can be sent in /policy/api/v1/infra
+    # requests, others such as project segments only one at a time
+    return segment["url"].startswith(("/policy/api/v1/infra/segments/",
+                                      "/policy/api/v1/infra/tier-1s/"))
+
+def childSegments(segments, remove=False):
+    '''
+    Infra children for a list of infra segment entries from the plan, a
+    ChildSegment for each infra segment and one ChildTier1 per tier-1
+    gateway holding a ChildSegment for each of its segments
+    '''
+    children = []
+    tier1s = {}
     for segment in segments:
-        if not remove:
-            if segment["method"] == "patch":
-                nsx.patch(api=segment["url"], data=segment["payload"],
-                          verbose=True, codes=[200], trial=trial)
+        # url is /policy/api/v1/infra/segments/<id> or
+        # /policy/api/v1/infra/tier-1s/<tier1>/segments/<id>
+        path = segment["url"].rstrip("/").split("/")
+        child = {"resource_type": "ChildSegment", "Segment": segmentPayload(segment)}
+        if path[-4] != "tier-1s":
+            children.append(child)
+        elif path[-3] in tier1s:
+            tier1s[path[-3]].append(child)
         else:
-            action = True
-            if rfilter and segment["display_name"] in rfilter:
-                action=True
-            else:
-                action=False
-                
-            if segment["method"] == "patch":
-                segment["payload"]["tags"] = segment["original_tags"]
-                nsx.patch(api=segment["url"], data=segment["payload"],
+            tier1s[path[-3]] = [child]
+    return children + [{"resource_type": "ChildTier1",
+                        "Tier1": {"resource_type": "Tier1", "id": t, "children": tier1s[t]}}
+                       for t in tier1s]
+
+def succeeded(r, codes):
+    # r is None in trial mode, nothing was applied
+    return r is not None and r.status_code in codes
+
+def journaled(journal, key, fn, *args, detail=None, **kwargs):
+    '''
+    Run fn(*args, **kwargs) and record key in journal if it returns True
+    '''
+    ok = fn(*args, **kwargs)
+    if ok and journal:
+        journal.record(key, detail)
+    return ok
+
+# the plan can list a URL more than once with different payloads, so
+# entries are journaled by their position in the plan along with the URL
+
+def groupKey(group, remove):
+    return "%s %d %s" %("group-delete" if remove else "group", group["position"], group["url"])
+
+def segmentKey(segment, remove):
+    return "%s %d %s" %("segment-restore" if remove else "segment", segment["position"], segment["url"])
+
+def applyBatch(nsx, batch, children, single, remove=False, trial=False,
+               journal=None, key=None):
+    data = {"resource_type": "Infra", "children": children(batch, remove)}
+    r = nsx.patch(api="/policy/api/v1/infra", data=data,
+                  verbose=True, codes=[200], trial=trial)
+    if r is None:
+        return
+    if r.status_code == 200:
+        if journal:
+            for entry in batch:
+                journal.record(key(entry, remove))
+        return
+    nsx.logger.log(nsx.logger.WARN, "Hierarchical request for %d objects failed with %d, retrying one at a time"
+                   %(len(batch), r.status_code))
+    for entry in batch:
+        journaled(journal, key(entry, remove), single, nsx, entry, remove, trial=trial)
+
+def applyBatches(nsx, entries, children, single, batchsize, remove=False, trial=False,
+                 engine=None, journal=None, key=None):
+    '''
+    Send entries in hierarchical PATCH /policy/api/v1/infra requests of up to
+    batchsize objects each.  The whole request fails if any object in it is
+    invalid, so a failed batch is retried one object at a time to apply the
+    good ones and isolate the bad one.
+    children - function returning the Infra children for a list of entries
+    single - function(nsx, entry, remove, trial) applying one entry with
+             its own API call, returns True on success
+    journal, key - completed entries are recorded in journal as key(entry, remove)
+    '''
+    if not engine:
+        engine = ApplyEngine(nsx.logger)
+    batch = []
+    for entry in entries:
+        batch.append(entry)
+        if len(batch) >= batchsize:
+            engine.submit(applyBatch, nsx, batch, children, single,
+                          remove=remove, trial=trial, journal=journal, key=key)
+            batch = []
+    if batch:
+        engine.submit(applyBatch, nsx, batch, children, single,
+                      remove=remove, trial=trial, journal=journal, key=key)
+
+def applyOneGroup(nsx, group, remove, trial=False):
+    if not remove:
+        if group["method"] == "patch":
+            r = nsx.patch(api=group["url"], data=group["payload"],
                           verbose=True, codes=[200], trial=trial)
+            return succeeded(r, [200])
+        return False
+    else:
+        r = nsx.delete(api=group["url"], verbose=True, codes=[200, 201], trial=trial)
+        return succeeded(r, [200, 201])
+
+def fetchExistingGroups(nsx, groups):
+    '''
+    Download the groups of every domain used in groups, one paged GET per
+    domain, and return them by the URL the plan uses for them
+    '''
+    existing = {}
+    domains = set(group["url"].rstrip("/").rsplit("/groups/", 1)[0] for group in groups)
+    for domain in sorted(domains):
+        for group in nsx.iterResults(api="%s/groups" % domain, verbose=False, codes=[200]):
+            existing["%s/groups/%s" %(domain, group["id"])] = group
+    return existing
+
+# set by NSX, not by the plan, never compared
+serverManaged = ["id", "resource_type", "path", "relative_path", "parent_path", "remote_path",
+                 "unique_id", "realization_id", "marked_for_delete", "overridden",
+                 "owner_id", "origin_site_id"]
+
+def tagSet(tags):
+    return set((t.get("scope", ""), t.get("tag", "")) for t in tags or [])
+
+def groupChanged(current, group, logger):
+    '''
+    True if the group on NSX differs from the planned payload in any key the
+    plan sets.  Keys NSX adds or manages, and underscore keys like _revision,
+    are ignored.  Expressions are compared ignoring member order, tags
+    ignoring order, and a missing value is the same as an empty one
+    '''
+    for key, value in group["payload"].items():
+        if key.startswith("_") or key in serverManaged:
+            continue
+        if key == "expression":
+            for e in current.get("expression", []):
+                if e["resource_type"] not in fingerprintTypes:
+                    # defined outside this tool, can't be compared
+                    return True
+            if (groupFingerprint({"expression": current.get("expression", [])}, logger) !=
+                groupFingerprint(group["payload"], logger)):
+                return True
+        elif key == "tags":
+            if tagSet(current.get("tags")) != tagSet(value):
+                return True
+        elif (current.get(key) or None) != (value or None):
+            return True
+    return False
+
+def applyGroup(nsx, groups, remove, rfilter, trial=False, batchsize=0, engine=None,
+               force=True, journal=None):
+    '''
+    groups - group entries, a list or a re-iterable PlanReader array
+    force - if False, groups are compared with the ones already on NSX
+            and only new or changed groups are sent
+    journal - Journal of completed operations, recorded groups are skipped
+    '''
+    if not engine:
+        engine = ApplyEngine(nsx.logger)
+    existing = None
+    counts = {"created": 0, "updated": 0, "skipped": 0}
+    if not remove and not force:
+        existing = fetchExistingGroups(nsx, groups)
+
+    def selected():
+        for position, group in enumerate(groups):
+            group["position"] = position
+            if journal and journal.done(groupKey(group, remove)):
+                continue
+            if not remove:
+                if group["method"] == "patch":
+                    if existing is not None:
+                        current = existing.get(group["url"].rstrip("/"))
+                        if not current:
+                            counts["created"]+=1
+                        elif groupChanged(current, group, nsx.logger):
+                            counts["updated"]+=1
+                        else:
+                            counts["skipped"]+=1
+                            continue
+                    yield group
+            else:
+                action = True
+                if rfilter and group["display_name"] in rfilter:
+                    action=True
+                else:
+                    action=False
+                if action:
+                    yield group
+
+    if batchsize:
+        applyBatches(nsx, selected(), childGroups, applyOneGroup,
+                     batchsize, remove=remove, trial=trial, engine=engine,
+                     journal=journal, key=groupKey)
+    else:
+        for group in selected():
+            engine.submit(journaled, journal, groupKey(group, remove),
+                          applyOneGroup, nsx, group, remove, trial=trial)
+    if existing is not None:
+        msg = ("Groups: %d unchanged skipped, %d to create, %d to update"
+               %(counts["skipped"], counts["created"], counts["updated"]))
+        nsx.logger.log(nsx.logger.INFO, msg)
+        print(msg)
+
+def applyOneSegment(nsx, segment, remove, trial=False):
+    r = nsx.patch(api=segment["url"], data=segmentPayload(segment),
+                  verbose=True, codes=[200], trial=trial)
+    return succeeded(r, [200])
+
+def applySegmentTags(nsx, segments, remove, rfilter, trial=False, batchsize=0, engine=None,
+                     journal=None):
+    if not engine:
+        engine = ApplyEngine(nsx.logger)
+
+    def selected():
+        for position, segment in enumerate(segments):
+            segment["position"] = position
+            if journal and journal.done(segmentKey(segment, remove)):
+                continue
+            if not remove:
+                if segment["method"] == "patch":
+                    yield segment
+            else:
+                # without --rfilter every segment's tags are restored
+                action = True
+                if not rfilter or segment.get("display_name", segment["payload"]["display_name"]) in rfilter:
+                    action=True
+                else:
+                    action=False
+                if action and segment["method"] == "patch":
+                    segment["payload"]["tags"] = segment["original_tags"]
+                    yield segment
+
+    def single(segments):
+        for segment in segments:
+            engine.submit(journaled, journal, segmentKey(segment, remove),
+                          applyOneSegment, nsx, segment, remove, trial=trial)
+
+    if batchsize:
+        others = []
+        def batched():
+            for segment in selected():
+                if infraSegment(segment):
+                    yield segment
+                else:
+                    others.append(segment)
+        applyBatches(nsx, batched(), childSegments, applyOneSegment,
+                     batchsize, remove=remove, trial=trial, engine=engine,
+                     journal=journal, key=segmentKey)
+        single(others)
+    else:
+        single(selected())
             
 
-def applyVMTags(nsx, scopes, remove, rfilter, allvmnames, allvmids, pagesize=1000, trial=False):
-    for scope in scopes:
-        if not remove:
-            for tag in scope["tags"]:
-                cursor = 0
-                vmlist = tag["apply_to"][0]["resource_ids"]
-                
-                while(cursor < len(vmlist)):
-                    tag["apply_to"][0]["resource_ids"] = vmlist[cursor:cursor+pagesize]
-                    api="/policy/api/v1/infra/tags/tag-operations/vm_tag_op_%s" % uuid.uuid4()
-                    nsx.put(api=api, data=tag, verbose=True, codes=[200], trial=trial)
-                    cursor+=pagesize
+def tagOperation(tag, key, resource_ids):
+    '''
+    Copy of tag operation payload with the apply_to or remove_from
+    resource_ids replaced, so concurrent requests don't share a list
+    '''
+    op = dict(tag)
+    op[key] = [dict(tag[key][0], resource_ids=resource_ids)] + tag[key][1:]
+    return op
+
+def tagKey(action, scope, tag, start, end):
+    # tag operation ids are random and the same tag can be listed more than
+    # once in a scope, so the journal identifies a chunk by its position in
+    # the plan: scope index, tag index and resource_ids offsets
+    return "%s %d %d %d %d" %(action, scope, tag, start, end)
+
+def completedTagRanges(journal, action):
+    '''
+    (scope index, tag index) to sorted (start, end) resource_ids offsets of
+    the chunks of action recorded in journal.  Chunk sizes vary from run
+    to run, so resumed runs skip offsets rather than chunks
+    '''
+    ranges = {}
+    if not journal:
+        return ranges
+    for key in journal.keys(action + " "):
+        s, t, start, end = [int(i) for i in key.split()[1:]]
+        if (s, t) in ranges:
+            ranges[(s, t)].append((start, end))
         else:
-            for tag in scope["tagsremove"]:
-                cursor = 0
-                vmlist = tag["remove_from"][0]["resource_ids"]
-                while(cursor < len(vmlist)):
-                    if not rfilter:
-                        tag["remove_from"][0]["resource_ids"] = vmlist[cursor:cursor+pagesize]
-                    else:
-                        tag["remove_from"][0]["resource_ids"] = []
-                        for n in rfilter:
-                            if n in allvmnames:
-                                tag["remove_from"][0]["resource_ids"].append(allids[allvmnames.index(n)])
-                    api="/policy/api/v1/infra/tags/tag-operations/vm_tag_op_%s" % uuid.uuid4()
-                    nsx.put(api=api, data=tag, verbose=True, codes=[200], trial=trial)
-                    cursor+=pagesize
+            ranges[(s, t)] = [(start, end)]
+    for r in ranges.values():
+        r.sort()
+    return ranges
+
+def pendingRanges(done, count):
+    '''
+    (start, end) ranges of 0 to count not covered by the sorted done ranges
+    '''
+    pending = []
+    cursor = 0
+    for start, end in done:
+        if start > cursor:
+            pending.append((cursor, min(start, count)))
+        cursor = max(cursor, end)
+    if cursor < count:
+        pending.append((cursor, count))
+    return pending
+
+def resolveFilterIds(nsx, rfilter, logger):
+    '''
+    Resolve the VM names in rfilter to the set of their external_ids with
+    one pass over the VM inventory.  Every VM with a listed name matches
+    '''
+    byName = {}
+    for vm in nsx.iterResults(api="/policy/api/v1/infra/realized-state/virtual-machines",
+                              codes=[200], verbose=False):
+        if vm["display_name"] in rfilter:
+            if vm["display_name"] in byName:
+                byName[vm["display_name"]].append(vm["external_id"])
+            else:
+                byName[vm["display_name"]] = [vm["external_id"]]
+    ids = set()
+    for ext in byName.values():
+        ids.update(ext)
+    unmatched = sorted(n for n in rfilter if n not in byName)
+    msg = ("Removal filter: %d names matched %d VMs, %d names not found"
+           %(len(byName), len(ids), len(unmatched)))
+    logger.log(logger.INFO, msg)
+    print(msg)
+    if unmatched:
+        logger.log(logger.WARN, "Removal filter names with no VM: %s" % ", ".join(unmatched))
+    return ids
+
+def putTagOperation(nsx, api, op, trial=False):
+    r = nsx.put(api=api, data=op, verbose=True, codes=[200], trial=trial)
+    return succeeded(r, [200])
+
+def applyTagOperation(nsx, engine, sizer, tag, key, ids, ranges, action, s, t,
+                      trial=False, journal=None, opids=None):
+    '''
+    Send one tag's operations for the ids in ranges, one chunk at a time,
+    each chunk as large as sizer currently allows.  Timed out chunks are
+    retried smaller until the minimum size also times out.
+    opids - list the ids of successful tag operations are appended to
+    '''
+    for start, end in ranges:
+        cursor = start
+        while cursor < end:
+            size = sizer.size()
+            last = min(end, cursor + size)
+            opid = "vm_tag_op_%s" % uuid.uuid4()
+            api = "/policy/api/v1/infra/tags/tag-operations/%s" % opid
+            op = tagOperation(tag, key, ids[cursor:last])
+            began = time.time()
+            # NsxConnect retries 429s itself, the throttled count shows the
+            # manager is pushing back even when the request succeeded
+            throttled = nsx.getThrottleStats()["throttled"]
+            try:
+                ok = engine.measure(putTagOperation, nsx, api, op, trial=trial)
+            except requests.exceptions.Timeout:
+                if last - cursor <= sizer.minimum:
+                    raise
+                sizer.update(last - cursor, None, False)
+                nsx.logger.log(nsx.logger.WARN, "Tag operation for %d VMs timed out, retrying with %d"
+                               %(last - cursor, sizer.size()))
+                continue
+            sizer.update(last - cursor, time.time() - began, ok,
+                         throttled=nsx.getThrottleStats()["throttled"] > throttled)
+            if ok:
+                if journal:
+                    journal.record(tagKey(action, s, t, cursor, last), opid)
+                if opids is not None:
+                    opids.append(opid)
+            cursor = last
+
+def tagOperationStatus(nsx, opid, statuses):
+    r = nsx.get(api="/policy/api/v1/infra/tags/tag-operations/%s/status" % opid,
+                verbose=False, codes=[200])
+    statuses[opid] = r.get("status") if r else None
+
+def waitForTagOperations(nsx, opids, timeout, workers=4):
+    '''
+    Poll the status of every tag operation in opids, in rounds with a
+    growing pause between them, until none is in progress or timeout
+    seconds have passed.  At most workers polls are in flight, outside the
+    ApplyEngine so they don't count as applied operations
+    '''
+    pending = list(opids)
+    failed = []
+    deadline = time.time() + timeout
+    pause = 1
+    while pending:
+        statuses = {}
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for future in [pool.submit(tagOperationStatus, nsx, opid, statuses) for opid in pending]:
+                future.result()
+        stillPending = []
+        for opid in pending:
+            if statuses.get(opid) in [None, "IN_PROGRESS", "PENDING"]:
+                stillPending.append(opid)
+            elif statuses[opid] != "SUCCESS":
+                failed.append("%s (%s)" %(opid, statuses[opid]))
+        pending = stillPending
+        if not pending or time.time() + pause > deadline:
+            break
+        time.sleep(pause)
+        pause = min(pause * 2, 10)
+    msg = ("Tag operations: %d realized, %d failed, %d still in progress"
+           %(len(opids) - len(pending) - len(failed), len(failed), len(pending)))
+    nsx.logger.log(nsx.logger.INFO, msg)
+    print(msg)
+    if failed:
+        nsx.logger.log(nsx.logger.WARN, "Failed tag operations: %s" % ", ".join(failed))
+
+def applyVMTags(nsx, scopes, remove, rfilterIds, pagesize=1000, trial=False,
+                engine=None, journal=None, wait=0):
+    '''
+    Submit the tag operations of each tag as one job, so different tags are
+    applied in parallel while each tag's chunks go out in order.
+    scopes - the plan's scopes list, or a PlanReader to stream them from
+    rfilterIds - if removing, set of VM external_ids to restrict removal to,
+                 None to remove the tags from every VM in the plan
+    pagesize - starting number of VMs per tag operation, adjusted to the
+               response times
+    wait - if set, seconds to wait for the tag operations to be realized
+    '''
+    if not engine:
+        engine = ApplyEngine(nsx.logger)
+    sizer = ChunkSizer(size=pagesize)
+    opids = [] if wait else None
+    if not remove:
+        action = "tag-apply"
+        key = "apply_to"
+        listname = "tags"
+    else:
+        action = "tag-remove"
+        key = "remove_from"
+        listname = "tagsremove"
+    completed = completedTagRanges(journal, action)
+    if isinstance(scopes, PlanReader):
+        tags = scopes.scopeTags(listname)
+    else:
+        tags = ((s, t, tag) for s, scope in enumerate(scopes)
+                for t, tag in enumerate(scope[listname]))
+    for s, t, tag in tags:
+        ids = tag[key][0]["resource_ids"]
+        if remove and rfilterIds is not None:
+            ids = [i for i in ids if i in rfilterIds]
+        done = completed.get((s, t), [])
+        ranges = pendingRanges(done, len(ids))
+        if journal and done:
+            journal.skip(len(done))
+        if ranges:
+            engine.submitJob(applyTagOperation, nsx, engine, sizer, tag, key, ids, ranges,
+                             action, s, t, trial=trial, journal=journal, opids=opids)
+    if wait and not trial:
+        engine.barrier()
+        waitForTagOperations(nsx, opids, wait, workers=min(4, engine.workers))
+    nsx.logger.log(nsx.logger.INFO, "Tag operation sizes: %s" % sizer.stats())
 
                 
 def main():
@@ -114,48 +569,73 @@ def main():
     logger = Logger(args.logfile)
     if not args.password:
         args.password = getpass.getpass("NSX Manager %s password: " %args.nsx)
-    with open(args.input, 'r', newline='') as fp:
-        data = json.load(fp)
-        fp.close()
+    # the plan is streamed one object at a time, never loaded whole
+    plan = PlanReader(args.input)
 
     if not args.globalmanager:
         nsx = NsxConnect(server=args.nsx, logger=logger, 
-                         user=args.user, password=args.password)
+                         user=args.user, password=args.password, rate_limit=args.rate,
+                         pool_maxsize=max(10, args.workers), timeout=args.timeout)
     else:
         nsx = NsxConnect(server=args.nsx, logger=logger, global_infra=True, global_gm=True,
-                         user=args.user, password=args.password)
+                         user=args.user, password=args.password, rate_limit=args.rate,
+                         pool_maxsize=max(10, args.workers), timeout=args.timeout)
 
     if args.remove and args.rfilter:
         with open(args.rfilter, 'r') as fp:
             csvreader = csv.reader(fp)
             rcsv = [row for row in csvreader]
-            rfilter=[]
+            rfilter=set()
             for row in rcsv:
-                rfilter.append(row[0])
+                rfilter.add(row[0])
             fp.close()
-            allvmms = nsx.get(api="/policy/api/v1/infra/realized-state/virtual-machines",
-                              code=[200], verbose=False, display=False)
-            allvmnames=[v["display_name"] for v in allvms]
-            allvmids = [v["external_id"] for v in allvms]
+        rfilterIds = None
+        if args.mode in ["vm", "all"]:
+            rfilterIds = resolveFilterIds(nsx, rfilter, logger)
     else:
         rfilter=None
-        allvmnames=[]
-        allvmids=[]
+        rfilterIds=None
 
 
-    if args.mode == "group":
-        applyGroup(nsx, data["groups"], args.remove, rfilter, trial=args.trial)
-    elif args.mode == "vm":
-        applyVMTags(nsx, data["scopes"], args.remove, rfilter, allvmnames, allvmids, trial=args.trial)
-    elif args.mode == "segment":
-        applySegmentTags(nsx, data["segments"], args.remove, rfilter, trial=args.trial)
-    elif args.mode == 'all':
-        applyGroup(nsx, data["groups"], args.remove, rfilter, trial=args.trial)
-        applyVMTags(nsx, data["scopes"], args.remove, rfilter, allvmnames, allvmids, trial=args.trial)
-        applySegmentTags(nsx, data["segments"], args.remove, rfilter, trial=args.trial)
+    engine = ApplyEngine(logger, workers=args.workers)
+    journal = None
+    if not args.trial:
+        journal = Journal(args.journal if args.journal else args.input + ".journal",
+                          logger, resume=args.resume, plan=args.input)
+    try:
+        segmentBatch = args.batch_size if args.batch_segments else 0
+        if args.mode == "group":
+            applyGroup(nsx, plan.array("groups"), args.remove, rfilter, trial=args.trial,
+                       batchsize=args.batch_size, engine=engine, force=args.force,
+                       journal=journal)
+        elif args.mode == "vm":
+            applyVMTags(nsx, plan, args.remove, rfilterIds, trial=args.trial,
+                        engine=engine, journal=journal, pagesize=args.tag_batch,
+                        wait=args.wait_realization)
+        elif args.mode == "segment":
+            applySegmentTags(nsx, plan.array("segments"), args.remove, rfilter, trial=args.trial,
+                             batchsize=segmentBatch, engine=engine, journal=journal)
+        elif args.mode == 'all':
+            applyGroup(nsx, plan.array("groups"), args.remove, rfilter, trial=args.trial,
+                       batchsize=args.batch_size, engine=engine, force=args.force,
+                       journal=journal)
+            if args.ordered:
+                engine.barrier()
+            applyVMTags(nsx, plan, args.remove, rfilterIds, trial=args.trial,
+                        engine=engine, journal=journal, pagesize=args.tag_batch,
+                        wait=args.wait_realization)
+            applySegmentTags(nsx, plan.array("segments"), args.remove, rfilter, trial=args.trial,
+                             batchsize=segmentBatch, engine=engine, journal=journal)
+        engine.close()
+    finally:
+        # keep what completed even if the run is dying
+        engine.shutdown()
+        if journal:
+            journal.close()
+    engine.report()
+    logger.log(logger.INFO, "API requests: %s" %nsx.getThrottleStats())
 
     
     
-    
 if __name__ == "__main__":
     main()
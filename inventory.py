@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+import time
+import json
+import gzip
+import os
+from concurrent.futures import ThreadPoolExecutor
+from planreader import PlanParser
+
+
+class NetworkInventory():
+    # search resource_type for each object type used in the CSV
+    searchTypes = {"segment": "Segment", "tier0": "Tier0", "tier1": "Tier1"}
+
+    def __init__(self, nsx, logger):
+        '''
+        Snapshot of the NSX network inventory taken once per run.
+        nsx - NsxConnect, may be None if the snapshot is filled from
+              another source with setObjects()
+        '''
+        self.nsx = nsx
+        self.logger = logger
+        self.objects = {}
+        self.byName = {}
+        self.byPath = {}
+        self.ports = None
+        self.segmentsByParent = None
+        self.tier1sByTier0 = None
+
+    def fetch(self, objectType):
+        '''
+        Download all objects of objectType (segment, tier0 or tier1)
+        '''
+        objs = self.nsx.get(api="/policy/api/v1/search/query?query=resource_type:%s"
+                            % self.searchTypes[objectType],
+                            codes=[200], verbose=False, display=False)
+        return objs["results"]
+
+    def fetchSegmentPorts(self):
+        ports = self.nsx.get(api="/policy/api/v1/search/query?query=resource_type:SegmentPort",
+                             codes=[200], verbose=False, display=False)
+        return ports["results"]
+
+    def load(self, workers=3):
+        '''
+        Download segments, Tier0s and Tier1s concurrently
+        '''
+        start = time.time()
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = {}
+            for objectType in self.searchTypes:
+                futures[objectType] = pool.submit(self.fetch, objectType)
+            for objectType in futures:
+                self.setObjects(objectType, futures[objectType].result())
+        self.logger.log(self.logger.INFO, "Network inventory: %d segments, %d Tier0s, %d Tier1s in %.1fs"
+                        %(self.count("segment"), self.count("tier0"),
+                          self.count("tier1"), time.time() - start))
+        return self
+
+    def setObjects(self, objectType, objs):
+        self.objects[objectType] = objs
+        self.segmentsByParent = None
+        self.tier1sByTier0 = None
+        self.byName[objectType] = {}
+        for o in objs:
+            name = o["display_name"].strip().lower()
+            if name not in self.byName[objectType]:
+                self.byName[objectType][name] = o
+            self.byPath[o["path"]] = o
+
+    def count(self, objectType):
+        return len(self.objects[objectType])
+
+    def getObjects(self, objectType):
+        '''
+        objectType - segment, tier0 or tier1; network returns the segments
+        '''
+        if objectType == "network":
+            objectType = "segment"
+        return self.objects[objectType]
+
+    def findByName(self, objectType, name):
+        '''
+        Case insensitive exact match, returns the first object with name or None
+        '''
+        if objectType == "network":
+            objectType = "segment"
+        return self.byName[objectType].get(name.strip().lower())
+
+    def getByPath(self, path):
+        return self.byPath.get(path)
+
+    def buildTopology(self):
+        '''
+        Parent path to children maps: segments by connectivity_path and
+        Tier1s by tier0_path.  Children keep their inventory order
+        '''
+        self.segmentsByParent = {}
+        for segment in self.objects["segment"]:
+            if "connectivity_path" not in segment:
+                continue
+            if segment["connectivity_path"] in self.segmentsByParent:
+                self.segmentsByParent[segment["connectivity_path"]].append(segment["path"])
+            else:
+                self.segmentsByParent[segment["connectivity_path"]] = [segment["path"]]
+        self.tier1sByTier0 = {}
+        for t1 in self.objects["tier1"]:
+            if "tier0_path" not in t1:
+                continue
+            if t1["tier0_path"] in self.tier1sByTier0:
+                self.tier1sByTier0[t1["tier0_path"]].append(t1["path"])
+            else:
+                self.tier1sByTier0[t1["tier0_path"]] = [t1["path"]]
+
+    def getGatewaySegments(self, gw):
+        '''
+        Return the segments connected to gateway gw and, for a Tier0, the
+        segments of every Tier1 connected to it
+        '''
+        if self.segmentsByParent is None:
+            self.buildTopology()
+        paths = list(self.segmentsByParent.get(gw["path"], []))
+        if gw["resource_type"] == "Tier0":
+            for t1 in self.tier1sByTier0.get(gw["path"], []):
+                paths.extend(self.segmentsByParent.get(t1, []))
+        return [self.byPath[p] for p in paths]
+
+    def toDict(self):
+        '''
+        Objects, segment ports and topology as a JSON serializable dict
+        '''
+        if self.segmentsByParent is None:
+            self.buildTopology()
+        data = {}
+        data["objects"] = self.objects
+        data["ports"] = self.getSegmentPorts()
+        data["topology"] = {"segmentsByParent": self.segmentsByParent,
+                            "tier1sByTier0": self.tier1sByTier0}
+        return data
+
+    def fromDict(self, data):
+        for objectType in data["objects"]:
+            self.setObjects(objectType, data["objects"][objectType])
+        self.ports = data["ports"]
+        self.segmentsByParent = data["topology"]["segmentsByParent"]
+        self.tier1sByTier0 = data["topology"]["tier1sByTier0"]
+
+    def save(self, filename):
+        '''
+        Write the snapshot, segment ports and topology to filename as JSON
+        '''
+        data = self.toDict()
+        data["timestamp"] = time.time()
+        with open(filename, "w") as fp:
+            fp.write(json.dumps(data))
+        self.logger.log(self.logger.INFO, "Network inventory saved to %s" %filename)
+
+    def loadFile(self, filename, maxage=None):
+        '''
+        Load a snapshot written by save().  Returns False if the file does
+        not exist or is older than maxage seconds
+        '''
+        if not os.path.exists(filename):
+            return False
+        with open(filename, "r") as fp:
+            data = json.load(fp)
+        age = time.time() - data["timestamp"]
+        if maxage is not None and age > maxage:
+            self.logger.log(self.logger.INFO, "Network inventory %s is %ds old, reloading"
+                            %(filename, age))
+            return False
+        self.fromDict(data)
+        self.logger.log(self.logger.INFO, "Network inventory loaded from %s, %ds old"
+                        %(filename, age))
+        return True
+
+    def getSegmentPorts(self):
+        '''
+        Fetch every segment port with one paged search query, on first use,
+        and return them grouped by the path of their segment
+        '''
+        if self.ports is None:
+            self.setSegmentPorts(self.fetchSegmentPorts())
+        return self.ports
+
+    def setSegmentPorts(self, ports):
+        self.ports = {}
+        for port in ports:
+            if "parent_path" not in port:
+                continue
+            if port["parent_path"] in self.ports:
+                self.ports[port["parent_path"]].append(port)
+            else:
+                self.ports[port["parent_path"]] = [port]
+
+
+class InventorySnapshot():
+    version = 1
+
+    def __init__(self, logger, manager=None, vms=None, vifs=None, inventory=None):
+        '''
+        Everything grouptag.py reads from NSX for one plan: realized VMs,
+        VIFs, and the NetworkInventory of segments, gateways and segment
+        ports.  Saved as gzip compressed JSON so later runs can plan from
+        the file without connecting to NSX.
+        manager - NSX Manager the inventory was read from
+        vms, vifs - lists of realized VMs and VIFs, as downloaded or as
+              vmindex records, which are saved as their projected fields
+        '''
+        self.logger = logger
+        self.manager = manager
+        self.vms = vms
+        self.vifs = vifs
+        self.inventory = inventory
+        self.timestamp = None
+
+    def save(self, filename):
+        start = time.time()
+        data = {"version": self.version, "manager": self.manager,
+                "timestamp": time.time(), "vms": self.vms, "vifs": self.vifs,
+                "network": self.inventory.toDict()}
+        with gzip.open(filename, "wt", compresslevel=6) as fp:
+            json.dump(data, fp, default=lambda record: record.toDict())
+        self.logger.log(self.logger.INFO, "Inventory of %s saved to %s: %d VMs, %d VIFs in %.1fs"
+                        %(self.manager, filename, len(self.vms), len(self.vifs),
+                          time.time() - start))
+
+    def load(self, filename):
+        '''
+        Read a snapshot written by save(), its NetworkInventory has no NSX
+        connection
+        '''
+        start = time.time()
+        with gzip.open(filename, "rt") as fp:
+            data = json.load(fp)
+        if data.get("version") != self.version:
+            self.logger.log(self.logger.ERROR, "Inventory %s has unsupported version %s"
+                            %(filename, data.get("version")))
+        self.manager = data["manager"]
+        self.timestamp = data["timestamp"]
+        self.vms = data["vms"]
+        self.vifs = data["vifs"]
+        self.inventory = NetworkInventory(None, self.logger)
+        self.inventory.fromDict(data["network"])
+        self.logger.log(self.logger.INFO, "Inventory of %s loaded from %s, taken %s: %d VMs, %d VIFs in %.1fs"
+                        %(self.manager, filename, time.ctime(self.timestamp),
+                          len(self.vms), len(self.vifs), time.time() - start))
+        return self
+
+    def loadInto(self, filename, store, inventory):
+        '''
+        Read a snapshot written by save() into a VmStore and a NetworkStore
+        on its database, decoding one VM, VIF, network object or port at a
+        time so the snapshot is never held in memory.  vms and vifs are
+        set to their counts
+        '''
+        start = time.time()
+        with gzip.open(filename, "rt") as fp:
+            p = PlanParser(fp, filename, 1<<20)
+            for key in p.keys():
+                if key == "version":
+                    version = p.value()
+                    if version != self.version:
+                        self.logger.log(self.logger.ERROR, "Inventory %s has unsupported version %s"
+                                        %(filename, version))
+                elif key == "manager":
+                    self.manager = p.value()
+                elif key == "timestamp":
+                    self.timestamp = p.value()
+                elif key == "vms":
+                    self.vms = store.addVms(p.elements())
+                elif key == "vifs":
+                    self.vifs = store.addVifs(p.elements())
+                elif key == "network":
+                    # the topology is queried from the parent paths
+                    p.expect("{")
+                    for nkey in p.members():
+                        if nkey == "objects":
+                            p.expect("{")
+                            for objectType in p.members():
+                                inventory.setObjects(objectType, p.elements())
+                        elif nkey == "ports":
+                            inventory.setSegmentPorts(self.__ports(p))
+                        else:
+                            p.skip()
+                else:
+                    p.skip()
+        self.inventory = inventory
+        self.logger.log(self.logger.INFO, "Inventory of %s loaded from %s into %s, taken %s: %d VMs, %d VIFs in %.1fs"
+                        %(self.manager, filename, store.db.filename, time.ctime(self.timestamp),
+                          self.vms, self.vifs, time.time() - start))
+        return self
+
+    @staticmethod
+    def __ports(p):
+        # segment path to ports object, as a stream of ports
+        p.expect("{")
+        for path in p.members():
+            yield from p.elements()
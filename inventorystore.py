@@ -0,0 +1,344 @@
+#!/usr/bin/env python3
+import os
+import json
+import sqlite3
+import threading
+from vmindex import ipBounds, VmRecord, VifRecord
+from inventory import NetworkInventory
+
+
+class InventoryDb():
+    schema = [
+        "CREATE TABLE vms (pos INTEGER PRIMARY KEY, external_id TEXT, display_name TEXT, "
+        "lower TEXT, rlower TEXT, tags TEXT, attached INTEGER DEFAULT 0)",
+        "CREATE TABLE vifs (seq INTEGER PRIMARY KEY, external_id TEXT, owner_vm_id TEXT, "
+        "attachment_id TEXT, pos INTEGER)",
+        # ip is the address as fixed width hex, so text order is numeric order
+        "CREATE TABLE addresses (vif INTEGER, version INTEGER, ip TEXT)",
+        "CREATE TABLE objects (seq INTEGER PRIMARY KEY, type TEXT, path TEXT, name TEXT, "
+        "parent TEXT, data TEXT)",
+        "CREATE TABLE ports (seq INTEGER PRIMARY KEY, parent_path TEXT, data TEXT)",
+        "CREATE INDEX vms_external_id ON vms (external_id)",
+        "CREATE INDEX vms_lower ON vms (lower)",
+        "CREATE INDEX vms_rlower ON vms (rlower)",
+        "CREATE INDEX objects_name ON objects (type, name)",
+        "CREATE INDEX objects_path ON objects (path)",
+        "CREATE INDEX objects_parent ON objects (type, parent)",
+        "CREATE INDEX ports_parent_path ON ports (parent_path)",
+    ]
+    # built after the VIFs are loaded, so inserts don't maintain them
+    vifIndexes = [
+        "CREATE INDEX vifs_attachment ON vifs (attachment_id, pos)",
+        "CREATE INDEX addresses_ip ON addresses (version, ip)",
+    ]
+
+    def __init__(self, filename, logger, batch=1000):
+        '''
+        SQLite database holding the inventory for one run, so memory stays
+        flat however many VMs and VIFs the manager has.  The file is
+        recreated each run.
+        batch - rows inserted per statement while streaming the inventory
+        '''
+        self.filename = filename
+        self.logger = logger
+        self.batch = batch
+        if os.path.exists(filename):
+            os.remove(filename)
+        # loaded from the bootstrap threads, every use goes through the lock
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.lock = threading.Lock()
+        # scratch data, rebuilt from NSX if the run fails
+        self.execute("PRAGMA journal_mode=OFF", "PRAGMA synchronous=OFF", *self.schema)
+
+    def execute(self, *statements):
+        '''
+        Run statements, each a SQL string or a (SQL, arguments) tuple, in
+        one transaction
+        '''
+        with self.lock:
+            for statement in statements:
+                if isinstance(statement, tuple):
+                    self.db.execute(*statement)
+                else:
+                    self.db.execute(statement)
+            self.db.commit()
+
+    def executemany(self, sql, rows):
+        with self.lock:
+            self.db.executemany(sql, rows)
+            self.db.commit()
+
+    def query(self, sql, args=()):
+        with self.lock:
+            return self.db.execute(sql, args).fetchall()
+
+    def insert(self, sql, rows):
+        '''
+        Insert rows from an iterable in batches, returns the number inserted
+        '''
+        count = 0
+        pending = []
+        for row in rows:
+            pending.append(row)
+            if len(pending) >= self.batch:
+                self.executemany(sql, pending)
+                count+=len(pending)
+                pending = []
+        if pending:
+            self.executemany(sql, pending)
+            count+=len(pending)
+        return count
+
+
+class VmStore():
+    def __init__(self, db, logger):
+        '''
+        VmIndex over an InventoryDb.  Only the fields resolution uses are
+        stored: a VM's external_id, display_name and tags, and a VIF's
+        owner, lport_attachment_id and addresses.  VMs are returned as
+        VmRecord without attachments, in inventory order like VmIndex.
+        '''
+        self.db = db
+        self.logger = logger
+
+    def addVms(self, vms):
+        '''
+        Store VMs from an iterable, e.g. NsxConnect.iterResults
+        '''
+        def rows():
+            for vm in vms:
+                vm = VmRecord.fromVm(vm)
+                yield (vm.external_id, vm.display_name, vm.lower, vm.lower[::-1],
+                       json.dumps(vm.tags))
+        return self.db.insert("INSERT INTO vms (external_id, display_name, lower, rlower, tags) "
+                              "VALUES (?, ?, ?, ?, ?)", rows())
+
+    def addVifs(self, vifs):
+        '''
+        Store VIFs from an iterable, with their addresses parsed as
+        VifRecord does
+        '''
+        addresses = []
+        def rows():
+            for seq, vif in enumerate(vifs, start=1):
+                vif = VifRecord.fromVif(vif, self.logger)
+                for version, value in vif.addresses:
+                    addresses.append((seq, version, self.__hex(version, value)))
+                yield (seq, vif.external_id, vif.owner_vm_id, vif.lport_attachment_id)
+                if len(addresses) >= self.db.batch:
+                    self.db.executemany("INSERT INTO addresses VALUES (?, ?, ?)", addresses)
+                    del addresses[:]
+        count = self.db.insert("INSERT INTO vifs (seq, external_id, owner_vm_id, attachment_id) "
+                               "VALUES (?, ?, ?, ?)", rows())
+        if addresses:
+            self.db.executemany("INSERT INTO addresses VALUES (?, ?, ?)", addresses)
+        return count
+
+    @staticmethod
+    def __hex(version, value):
+        return "%08x" % value if version == 4 else "%032x" % value
+
+    def associateVifs(self, progress=True):
+        '''
+        Attach each stored VIF to its owning VM, the first VM with its
+        owner_vm_id as VmIndex does.  Orphan VIFs are reported like
+        VmIndex.associateVifs()
+        '''
+        vms = self.db.query("SELECT COUNT(*) FROM vms")[0][0]
+        vifs = self.db.query("SELECT COUNT(*) FROM vifs")[0][0]
+        if progress:
+            self.logger.log(self.logger.INFO, "Associating %d VIFs to %d VMs" %(vifs, vms))
+        self.db.execute(*self.db.vifIndexes)
+        self.db.execute("UPDATE vifs SET pos = (SELECT MIN(pos) FROM vms "
+                        "WHERE vms.external_id = vifs.owner_vm_id)",
+                        "UPDATE vms SET attached = 1 WHERE pos IN "
+                        "(SELECT pos FROM vifs WHERE pos IS NOT NULL)")
+        orphans = self.db.query("SELECT COUNT(*) FROM vifs WHERE pos IS NULL")[0][0]
+        attached = self.db.query("SELECT COUNT(*) FROM vms WHERE attached = 1")[0][0]
+        if orphans:
+            shown = ["%s (VM %s)" %(v[0], v[1]) for v in
+                     self.db.query("SELECT external_id, owner_vm_id FROM vifs WHERE pos IS NULL "
+                                   "ORDER BY seq LIMIT 100")]
+            if orphans > len(shown):
+                shown.append("...")
+            self.logger.log(self.logger.WARN, "%d VIFs have no matching VM: %s"
+                            %(orphans, ", ".join(shown)))
+        if progress:
+            self.logger.log(self.logger.INFO, "Associated %d VIFs, %d VMs have attachments"
+                            %(vifs - orphans, attached))
+        return orphans
+
+    def __vms(self, where, args=()):
+        vms = []
+        for row in self.db.query("SELECT external_id, display_name, tags FROM vms WHERE %s "
+                                 "ORDER BY pos" % where, args):
+            vms.append(VmRecord(row[0], row[1], json.loads(row[2])))
+        return vms
+
+    @property
+    def attached(self):
+        return self.__vms("attached = 1")
+
+    def get(self, external_id):
+        found = self.__vms("pos = (SELECT MIN(pos) FROM vms WHERE external_id = ?)", (external_id,))
+        return found[0] if found else None
+
+    def getByAttachment(self, attachment_id):
+        found = self.__vms("pos = (SELECT MIN(pos) FROM vifs WHERE attachment_id = ?)",
+                           (attachment_id,))
+        return found[0] if found else None
+
+    def getByAttachments(self, ids):
+        return [self.getByAttachment(i) for i in ids]
+
+    def nameIndex(self):
+        return self
+
+    def ipIndex(self):
+        return self
+
+    # NameIndex lookups, on the lowercase and reversed lowercase name indexes
+
+    def findOne(self, name):
+        return self.__vms("pos = (SELECT pos FROM vms WHERE lower = ? ORDER BY external_id, pos LIMIT 1)",
+                          (name.lower(),))
+
+    def startsWith(self, name):
+        name = name.lower()
+        return self.__vms("lower >= ? AND lower < ?", (name, name + "\U0010ffff"))
+
+    def endsWith(self, name):
+        name = name.lower()[::-1]
+        return self.__vms("rlower >= ? AND rlower < ?", (name, name + "\U0010ffff"))
+
+    def contains(self, name):
+        return self.__vms("instr(lower, ?) > 0", (name.lower(),))
+
+    # IpIndex lookups
+
+    def findRange(self, version, first, last):
+        return self.__vms("pos IN (SELECT vifs.pos FROM addresses JOIN vifs ON vifs.seq = addresses.vif "
+                          "WHERE addresses.version = ? AND addresses.ip BETWEEN ? AND ?)",
+                          (version, self.__hex(version, first), self.__hex(version, last)))
+
+    def find(self, ip):
+        bounds = ipBounds(ip)
+        if not bounds:
+            return []
+        return self.findRange(*bounds)
+
+
+class PortMap():
+    def __init__(self, db):
+        '''
+        Segment path to ports lookups over an InventoryDb, in place of the
+        dict NetworkInventory.getSegmentPorts() returns
+        '''
+        self.db = db
+
+    def get(self, path, default=None):
+        ports = [json.loads(row[0]) for row in
+                 self.db.query("SELECT data FROM ports WHERE parent_path = ? ORDER BY seq", (path,))]
+        return ports if ports else default
+
+    def toDict(self):
+        ports = {}
+        for row in self.db.query("SELECT parent_path, data FROM ports ORDER BY seq"):
+            ports.setdefault(row[0], []).append(json.loads(row[1]))
+        return ports
+
+
+class NetworkStore(NetworkInventory):
+    def __init__(self, nsx, logger, db):
+        '''
+        NetworkInventory with segments, gateways and segment ports kept in
+        an InventoryDb instead of memory
+        '''
+        NetworkInventory.__init__(self, nsx, logger)
+        self.db = db
+
+    def setObjects(self, objectType, objs):
+        self.db.execute(("DELETE FROM objects WHERE type = ?", (objectType,)))
+        count = self.db.insert("INSERT INTO objects (type, path, name, parent, data) VALUES (?, ?, ?, ?, ?)",
+                       ((objectType, o["path"], o["display_name"].strip().lower(),
+                         o.get("tier0_path") if objectType == "tier1" else o.get("connectivity_path"),
+                         json.dumps(o)) for o in objs))
+        # stored types and their counts, the objects are only in the database
+        self.objects[objectType] = count
+
+    def __objects(self, where, args=()):
+        return [json.loads(row[0]) for row in
+                self.db.query("SELECT data FROM objects WHERE %s ORDER BY seq" % where, args)]
+
+    def count(self, objectType):
+        return self.objects[objectType]
+
+    def getObjects(self, objectType):
+        if objectType == "network":
+            objectType = "segment"
+        return self.__objects("type = ?", (objectType,))
+
+    def findByName(self, objectType, name):
+        if objectType == "network":
+            objectType = "segment"
+        found = self.__objects("seq = (SELECT MIN(seq) FROM objects WHERE type = ? AND name = ?)",
+                               (objectType, name.strip().lower()))
+        return found[0] if found else None
+
+    def getByPath(self, path):
+        # the last object stored with path, as the byPath dict keeps
+        found = self.__objects("seq = (SELECT MAX(seq) FROM objects WHERE path = ?)", (path,))
+        return found[0] if found else None
+
+    def __children(self, objectType, parent):
+        return [row[0] for row in
+                self.db.query("SELECT path FROM objects WHERE type = ? AND parent = ? ORDER BY seq",
+                              (objectType, parent))]
+
+    def buildTopology(self):
+        self.segmentsByParent = {}
+        for row in self.db.query("SELECT parent, path FROM objects WHERE type = 'segment' "
+                                 "AND parent IS NOT NULL ORDER BY seq"):
+            self.segmentsByParent.setdefault(row[0], []).append(row[1])
+        self.tier1sByTier0 = {}
+        for row in self.db.query("SELECT parent, path FROM objects WHERE type = 'tier1' "
+                                 "AND parent IS NOT NULL ORDER BY seq"):
+            self.tier1sByTier0.setdefault(row[0], []).append(row[1])
+
+    def getGatewaySegments(self, gw):
+        paths = self.__children("segment", gw["path"])
+        if gw["resource_type"] == "Tier0":
+            for t1 in self.__children("tier1", gw["path"]):
+                paths.extend(self.__children("segment", t1))
+        return [self.getByPath(p) for p in paths]
+
+    def toDict(self):
+        self.buildTopology()
+        data = {}
+        data["objects"] = {}
+        for objectType in self.objects:
+            data["objects"][objectType] = self.getObjects(objectType)
+        data["ports"] = self.getSegmentPorts().toDict()
+        data["topology"] = {"segmentsByParent": self.segmentsByParent,
+                            "tier1sByTier0": self.tier1sByTier0}
+        self.segmentsByParent = None
+        self.tier1sByTier0 = None
+        return data
+
+    def fromDict(self, data):
+        # the topology is queried from the parent paths instead
+        for objectType in data["objects"]:
+            self.setObjects(objectType, data["objects"][objectType])
+        self.setSegmentPorts(port for path in data["ports"] for port in data["ports"][path])
+
+    def getSegmentPorts(self):
+        if self.ports is None:
+            self.setSegmentPorts(self.fetchSegmentPorts())
+        return self.ports
+
+    def setSegmentPorts(self, ports):
+        self.db.execute("DELETE FROM ports")
+        self.db.insert("INSERT INTO ports (parent_path, data) VALUES (?, ?)",
+                       ((port["parent_path"], json.dumps(port)) for port in ports
+                        if "parent_path" in port))
+        self.ports = PortMap(self.db)
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+import os
+import time
+import hashlib
+import threading
+
+
+def planIdentity(filename):
+    '''
+    "size mtime sha256" of a plan file, the journal's header line
+    '''
+    digest = hashlib.sha256()
+    with open(filename, "rb") as fp:
+        for block in iter(lambda: fp.read(1 << 20), b""):
+            digest.update(block)
+    st = os.stat(filename)
+    return "%d %d %s" %(st.st_size, int(st.st_mtime), digest.hexdigest())
+
+def samePlan(header, identity):
+    # size and content decide, a copied plan keeps its journal even
+    # though its modification time changed
+    fields = header.split()
+    return (len(fields) == 5 and fields[:2] == ["#", "plan"] and
+            fields[2] == identity.split()[0] and fields[4] == identity.split()[2])
+
+
+class Journal():
+    def __init__(self, filename, logger, resume=False, plan=None, syncEvery=100,
+                 syncInterval=1.0):
+        '''
+        Append-only record of completed operations, one key per line, used
+        to skip finished work when a long run is restarted.
+        filename - journal file
+        resume - if True, keys already in filename are loaded and the file
+                 is appended to, otherwise the file is started over
+        plan - plan file the keys refer to.  Its size, modification time
+               and hash are the journal's first line, a journal written for
+               a different plan isn't resumed but started over
+        syncEvery, syncInterval - the file is fsynced after this many
+                 records or this many seconds, whichever comes first, so
+                 a crash loses at most that much of the record
+        '''
+        self.filename = filename
+        self.logger = logger
+        self.syncEvery = syncEvery
+        self.syncInterval = syncInterval
+        self.lock = threading.Lock()
+        # keys completed by previous runs, read only once loaded.  Keys
+        # recorded by this run aren't added, a plan can repeat an entry
+        # and each occurrence is still sent
+        completed = set()
+        identity = planIdentity(plan) if plan else None
+        if resume and os.path.exists(filename):
+            complete = 0
+            with open(filename, "rb") as fp:
+                header = fp.readline().decode(errors="replace")
+                if identity and not samePlan(header, identity):
+                    self.logger.log(self.logger.WARN, "Journal %s was not written for plan %s as it is now, starting it over"
+                                    %(filename, plan))
+                    resume = False
+                else:
+                    fp.seek(0)
+                    for line in fp:
+                        # a crash can leave a partial last line without
+                        # newline, it could read as a different key
+                        if not line.endswith(b"\n"):
+                            break
+                        complete += len(line)
+                        line = line.decode().rstrip("\n")
+                        if not line.startswith("#"):
+                            completed.add(line.split("\t", 1)[0])
+            if resume:
+                if complete < os.path.getsize(filename):
+                    os.truncate(filename, complete)
+                self.logger.log(self.logger.INFO, "Resuming from journal %s, %d operations already completed"
+                                %(filename, len(completed)))
+        self.completed = frozenset(completed)
+        if resume and os.path.exists(filename):
+            self.fp = open(filename, "a")
+        else:
+            self.fp = open(filename, "w")
+            if identity:
+                self.fp.write("# plan %s\n" % identity)
+        self.unsynced = 0
+        self.synced = time.time()
+        self.skipped = 0
+
+    def done(self, key):
+        '''
+        True if key was completed by a previous run, counted as skipped
+        '''
+        if key in self.completed:
+            with self.lock:
+                self.skipped+=1
+            return True
+        return False
+
+    def keys(self, prefix):
+        '''
+        Keys completed by previous runs starting with prefix.  Safe while
+        workers record(), the previous run's keys never change
+        '''
+        return [key for key in self.completed if key.startswith(prefix)]
+
+    def skip(self, count=1):
+        '''
+        Count operations found completed without done(), e.g. through keys()
+        '''
+        with self.lock:
+            self.skipped+=count
+
+    def record(self, key, detail=None):
+        '''
+        Mark key completed.  detail, e.g. the tag operation id, is written
+        alongside for troubleshooting
+        '''
+        with self.lock:
+            if detail:
+                self.fp.write("%s\t%s\n" %(key, detail))
+            else:
+                self.fp.write("%s\n" % key)
+            self.unsynced+=1
+            if self.unsynced >= self.syncEvery or time.time() - self.synced >= self.syncInterval:
+                self.__sync()
+
+    def __sync(self):
+        self.fp.flush()
+        os.fsync(self.fp.fileno())
+        self.unsynced = 0
+        self.synced = time.time()
+
+    def close(self):
+        with self.lock:
+            self.__sync()
+            self.fp.close()
+        if self.skipped:
+            self.logger.log(self.logger.INFO, "Skipped %d operations completed by a previous run"
+                            % self.skipped)
@@ -1,5 +1,6 @@
 #/usr/bin/env python3
 import sys
+import threading
 from datetime import datetime
 
 class Logger():
@@ -12,6 +13,7 @@ class Logger():
         self.ERROR="ERROR"
         self.WARN="WARNING"
         self.INFO="INFO"
+        self.lock = threading.Lock()
 
     def info(self, msg):
         self.log(level=self.INFO, msg=msg)
@@ -22,7 +24,8 @@ class Logger():
         
     def log(self, level, msg):
         try:
-            self.fp.write("%s %s - %s\n" %(datetime.now(), level, msg))
+            with self.lock:
+                self.fp.write("%s %s - %s\n" %(datetime.now(), level, msg))
         except Exception as e:
             print("Failure to write log entry to file - %s" %e)
             exit()
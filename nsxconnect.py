@@ -5,17 +5,247 @@ from requests.structures import CaseInsensitiveDict
 import base64
 import json
 import copy
+import time
+import threading
+import os
+import hashlib
+from collections import OrderedDict
+from urllib.parse import urlsplit, parse_qsl, urlencode
+from email.utils import parsedate_to_datetime
+from concurrent.futures import ThreadPoolExecutor
 from logger import Logger
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.connection import HTTPConnection
 from requests.packages.urllib3.exceptions import InsecureRequestWarning
 requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
 
+class KeepAliveAdapter(HTTPAdapter):
+    def __init__(self, keepalive=None, **kwargs):
+        '''
+        HTTPAdapter that turns on TCP keepalive for its pooled connections
+        keepalive - seconds of idle time before the first probe, None to
+                    leave the socket at the OS default
+        '''
+        self.keepalive = keepalive
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        if self.keepalive:
+            options = list(HTTPConnection.default_socket_options)
+            options.append((socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1))
+            # probe options are not available on every platform
+            if hasattr(socket, "TCP_KEEPIDLE"):
+                options.append((socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, self.keepalive))
+            if hasattr(socket, "TCP_KEEPINTVL"):
+                options.append((socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, max(1, self.keepalive//3)))
+            if hasattr(socket, "TCP_KEEPCNT"):
+                options.append((socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 3))
+            kwargs["socket_options"] = options
+        super().init_poolmanager(*args, **kwargs)
+
+
+class RateLimiter():
+    def __init__(self, rate=None, burst=None, maxBackoff=60):
+        '''
+        Thread safe token bucket shared by every request to one NSX manager.
+        rate - requests per second, None for no limit other than the backoff
+        burst - bucket size, defaults to one second worth of requests
+        maxBackoff - longest pause in seconds after a throttled response
+                     without a Retry-After header
+        A 429 or 503 pauses every caller of the limiter for the Retry-After
+        time, or an exponentially growing backoff, and halves the rate.  The
+        rate recovers gradually as requests succeed.
+        '''
+        self.configuredRate = rate
+        self.rate = rate
+        self.capacity = burst if burst else max(1, rate or 1)
+        self.tokens = self.capacity
+        self.maxBackoff = maxBackoff
+        self.backoff = 0
+        self.blockedUntil = 0
+        # end of the pause already added to throttledTime, every waiting
+        # thread sees the same pause but it is counted once
+        self.countedUntil = 0
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.throttledCount = 0
+        self.throttledTime = 0.0
+        self.waitTime = 0.0
+
+    def acquire(self):
+        '''
+        Block until a request may be sent
+        '''
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if now < self.blockedUntil:
+                    wait = self.blockedUntil - now
+                    self.throttledTime += self.blockedUntil - max(now, self.countedUntil)
+                    self.countedUntil = self.blockedUntil
+                elif not self.rate:
+                    self.requests += 1
+                    return
+                else:
+                    self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        self.requests += 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+                    self.waitTime += wait
+            time.sleep(wait)
+
+    def throttled(self, retryAfter=None):
+        '''
+        Record a throttled response and return the pause in seconds
+        retryAfter - value of the Retry-After header, if any
+        '''
+        delay = None
+        if retryAfter:
+            try:
+                delay = float(retryAfter)
+            except ValueError:
+                try:
+                    delay = parsedate_to_datetime(retryAfter).timestamp() - time.time()
+                except (TypeError, ValueError):
+                    delay = None
+        with self.lock:
+            self.throttledCount += 1
+            if delay is None:
+                self.backoff = min(self.maxBackoff, self.backoff * 2 if self.backoff else 1)
+                delay = self.backoff
+            delay = max(0, delay)
+            self.blockedUntil = max(self.blockedUntil, time.monotonic() + delay)
+            if self.rate:
+                self.rate = max(self.configuredRate / 16.0, self.rate / 2.0)
+                self.tokens = min(self.tokens, 0)
+        return delay
+
+    def succeeded(self):
+        with self.lock:
+            self.backoff = 0
+            if self.rate and self.rate < self.configuredRate:
+                self.rate = min(self.configuredRate, self.rate + self.configuredRate / 20.0)
+
+    def stats(self):
+        with self.lock:
+            return {"requests": self.requests, "throttled": self.throttledCount,
+                    "throttled_seconds": round(self.throttledTime, 2),
+                    "rate_wait_seconds": round(self.waitTime, 2),
+                    "rate": self.rate}
+
+
+class ResponseCache():
+    def __init__(self, directory, ttl=86400, maxentries=100000):
+        '''
+        On disk cache of GET responses, one JSON file per entry, for
+        objects that are read again on later runs.
+        directory - where entries are stored, created if missing
+        ttl - seconds an entry is used for, without validation, before it
+              is fetched again
+        maxentries - least recently used entries are removed beyond this
+        An expected _revision or _last_modified_time, e.g. from a search
+        result, can be given on lookup so that changed objects miss even
+        within the ttl.
+        '''
+        self.directory = directory
+        self.ttl = ttl
+        self.maxentries = maxentries
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.evicted = 0
+        os.makedirs(directory, exist_ok=True)
+        # file name to last use, least recently used first
+        self.entries = OrderedDict()
+        files = [f for f in os.listdir(directory) if f.endswith(".json")]
+        for f in sorted(files, key=lambda f: os.path.getmtime(os.path.join(directory, f))):
+            self.entries[f] = True
+
+    @staticmethod
+    def key(url):
+        '''
+        Normalized URL: query parameters sorted, so equivalent requests
+        share an entry
+        '''
+        parts = urlsplit(url)
+        query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+        return "%s://%s%s?%s" %(parts.scheme, parts.netloc, parts.path.rstrip("/"), query)
+
+    def __filename(self, key):
+        return hashlib.sha1(key.encode()).hexdigest() + ".json"
+
+    def get(self, url, revision=None, modified=None):
+        '''
+        Return the cached payload for url, or None if there isn't a fresh
+        entry matching the expected revision and modification time
+        '''
+        key = self.key(url)
+        name = self.__filename(key)
+        path = os.path.join(self.directory, name)
+        with self.lock:
+            if name not in self.entries:
+                self.misses+=1
+                return None
+            try:
+                with open(path, "r") as fp:
+                    entry = json.load(fp)
+            except (OSError, ValueError):
+                self.entries.pop(name, None)
+                self.misses+=1
+                return None
+            payload = entry["payload"]
+            if (entry["key"] != key or time.time() - entry["time"] > self.ttl or
+                (revision is not None and payload.get("_revision") != revision) or
+                (modified is not None and payload.get("_last_modified_time") != modified)):
+                self.stale+=1
+                self.misses+=1
+                return None
+            self.entries.move_to_end(name)
+            os.utime(path)
+            self.hits+=1
+            return payload
+
+    def put(self, url, payload):
+        key = self.key(url)
+        name = self.__filename(key)
+        path = os.path.join(self.directory, name)
+        with self.lock:
+            # write and rename so a reader never sees a partial entry
+            tmp = "%s.%d.tmp" %(path, threading.get_ident())
+            with open(tmp, "w") as fp:
+                json.dump({"key": key, "time": time.time(), "payload": payload}, fp)
+            os.replace(tmp, path)
+            self.entries[name] = True
+            self.entries.move_to_end(name)
+            while len(self.entries) > self.maxentries:
+                old, _ = self.entries.popitem(last=False)
+                try:
+                    os.remove(os.path.join(self.directory, old))
+                except OSError:
+                    pass
+                self.evicted+=1
+
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "stale": self.stale,
+                    "evicted": self.evicted, "entries": len(self.entries)}
+
+
 class NsxConnect(requests.Request):
     def __init__(self, server, logger, port = 443,
                  user='admin', password=None, access_token=None, cookie=None, 
                  content='application/json', accept='application/json',
                  global_infra=False, global_gm=False, org='default',
                  site='default', enforcement='default', domain='default',
-                 cert=None, verify=False, timeout=None, project=None, isNsx=True):
+                 cert=None, verify=False, timeout=None, project=None, isNsx=True,
+                 rate_limit=None, limiter=None, max_retries=20,
+                 pool_connections=10, pool_maxsize=10, pool_block=False,
+                 keepalive=60, connect_timeout=None, cache=None):
         '''
         server - The NSX Manager IP or FQDN
         port - TCP port for server
@@ -23,6 +253,21 @@ class NsxConnect(requests.Request):
         password - Password for the user, not required when re-using session
                    or cert auth
         cookie - Session cookiefile
+        rate_limit - Maximum requests per second sent to the manager
+        limiter - RateLimiter to share with other NsxConnect instances for
+                  the same manager, rate_limit is ignored if provided
+        max_retries - Number of times a throttled (429/503) request is retried
+        timeout - Read timeout in seconds, None to wait forever
+        connect_timeout - TCP connect timeout in seconds, defaults to timeout
+        pool_connections - Number of host pools kept by the connection adapter
+        pool_maxsize - Connections kept open per host, set this to at least
+                       the number of threads sharing this NsxConnect
+        pool_block - Wait for a free pooled connection instead of opening an
+                     extra connection that is discarded after use
+        keepalive - TCP keepalive idle time in seconds, None to disable
+        cache - ResponseCache used by get() calls that ask for it
+        The instance may be shared by worker threads: each thread gets its
+        own Session, and all of them share one connection pool.
         
         
         '''
@@ -48,8 +293,18 @@ class NsxConnect(requests.Request):
         self.org=org
         self.project=project
         self.logger=logger
+        self.limiter = limiter if limiter else RateLimiter(rate=rate_limit)
+        self.max_retries = max_retries
+        self.cache = cache
+        if connect_timeout is not None:
+            self.timeout = (connect_timeout, timeout)
 
-        self.session = requests.Session()
+        self.adapter = KeepAliveAdapter(keepalive=keepalive,
+                                        pool_connections=pool_connections,
+                                        pool_maxsize=pool_maxsize,
+                                        pool_block=pool_block)
+        self.local = threading.local()
+        self.sessionConfig = {}
         
         if self.access_token:
               self.requestAttr = {
@@ -76,9 +331,9 @@ class NsxConnect(requests.Request):
         # if certificate given
         if self.cert:
             self.requestAttr.pop('auth')
-            self.session.cert = self.cert.split(',')
-            self.session.headers.update(self.requestAttr['headers'])
-            self.session.verify=verify
+            self.sessionConfig = {'cert': self.cert.split(','),
+                                  'headers': self.requestAttr['headers'],
+                                  'verify': verify}
             
         # revert to using auth if header is still there.  VIDM auth if @ in username          
         if 'auth' in self.requestAttr:
@@ -92,6 +347,24 @@ class NsxConnect(requests.Request):
             # pass for now because this is not used and need handler for GM exception
             #self.version = self.getVersion()
 
+    @property
+    def session(self):
+        '''
+        The calling thread's Session, created on first use.  requests.Session
+        is not safe to share between threads, the connection pool behind it is
+        '''
+        session = getattr(self.local, "session", None)
+        if session is None:
+            session = requests.Session()
+            session.mount("https://", self.adapter)
+            session.mount("http://", self.adapter)
+            if self.sessionConfig:
+                session.cert = self.sessionConfig['cert']
+                session.headers.update(self.sessionConfig['headers'])
+                session.verify = self.sessionConfig['verify']
+            self.local.session = session
+        return session
+
     def getVersion(self):
         # for API compatibility purposes, only get major and minor
         v = self.get(api='/api/v1/node/version', verbose=False, codes=[200])
@@ -199,15 +472,49 @@ class NsxConnect(requests.Request):
                           %(result.status_code, codes, result.text))
                           
 
-    def __checkApiLimit(self, result,verbose=True, codes=[429]):
-        if result.status_code in codes:
-            if verbose:
-                print("API limit exceeded")
-            return True
-        else:
-            return False
-            
-    def get(self, api, verbose=True, trial=False, codes=None, display=False):
+    def __request(self, method, url, **kwargs):
+        '''
+        Send one request through the rate limiter, retrying throttled
+        responses after the pause the limiter asks for
+        '''
+        retries = 0
+        while True:
+            self.limiter.acquire()
+            r = self.session.request(method, url, timeout=self.timeout,
+                                     **kwargs, **self.requestAttr)
+            if r.status_code not in [429, 503] or retries >= self.max_retries:
+                if r.status_code not in [429, 503]:
+                    self.limiter.succeeded()
+                return r
+            delay = self.limiter.throttled(r.headers.get("Retry-After"))
+            retries+=1
+            self.logger.info("API %s %s returned %d, retry %d in %.1f seconds"
+                             %(method, url, r.status_code, retries, delay))
+
+    def getThrottleStats(self):
+        return self.limiter.stats()
+
+    def __pageUrl(self, url, cursor=None, page_size=None):
+        params = []
+        if page_size:
+            params.append("page_size=%d" % page_size)
+        if cursor:
+            params.append("cursor=%s" % cursor)
+        if not params:
+            return url
+        return "%s%s%s" %(url, "&" if '?' in url else "?", "&".join(params))
+
+    def __getPage(self, url, verbose=True, codes=None):
+        if verbose:
+            self.logger.info("API: GET %s" %url)
+
+        r = self.__request("GET", url)
+
+        self.__checkReturnCode(r, codes)
+        return r
+
+    def get(self, api, verbose=True, trial=False, codes=None, display=False, page_size=None,
+            cache=False, revision=None, modified=None):
         '''
         REST API get request
         api - REST API, this will be appended to self.server
@@ -216,58 +523,98 @@ class NsxConnect(requests.Request):
                 combine with verbose=true to see what'll be submitted
                 NSX
         codes - List of HTTP request status codes for success
+        page_size - if set, number of results requested per cursor page
+        cache - if True and the connection has a ResponseCache, a cached
+                response is returned if fresh, and responses are cached
+        revision, modified - expected _revision and _last_modified_time of
+                the object, a cached copy that differs is fetched again
         '''
         api=self.normalizeGmLmApi(api)
         ourl = self.server+api
-        if not trial:
-            firstLoop = True
-            cursor=None
-            result={}
-            
-            while firstLoop or cursor:
-                firstLoop = False
-                if '?' in ourl:
-                    url = "%s&cursor=%s" %(ourl, cursor) if cursor else ourl
-                else:
-                    url = "%s?cursor=%s" %(ourl, cursor) if cursor else ourl
-                if verbose:
-                    self.logger.info("API: GET %s" %url)
-
-                r = self.session.get(url, timeout=self.timeout,
-                                     **self.requestAttr)
-                throttle=1
-                while self.__checkApiLimit(r):
-                    self.logger.info("API Limit exceeded, sleeping %s seconds and retrying"
-                                     % throttle)
-                    print("API Limit exceeded, sleeping %s seconds and retrying"
-                                     % throttle)
-                    time.sleep(throttle)
-                    r = self.session.get(url, timeout=self.timeout,
-                                         **self.requestAttr)
-                    throttle+=1
-                    
-                self.__checkReturnCode(r, codes)
-                payload = json.loads(r.text)
-                if "results" in result.keys():
-                    result["results"].extend(payload["results"])
-                else:
-                    result = payload
-                if "cursor" not in payload:
-                    return result
-                else:
-                    cursor=payload["cursor"]
-                        
+        if cache and self.cache and not trial:
+            result = self.cache.get(ourl, revision=revision, modified=modified)
+            if result is not None:
                 if verbose:
-                    self.logger.info("result code: %d" % r.status_code)
+                    self.logger.info("API: GET %s from cache" %ourl)
+                return result
+            result = self.__fetch(ourl, verbose=verbose, codes=codes, display=display,
+                                  page_size=page_size)
+            if "error_code" not in result:
+                self.cache.put(ourl, result)
+            return result
+        if not trial:
+            return self.__fetch(ourl, verbose=verbose, codes=codes, display=display,
+                                page_size=page_size)
         else:
             if verbose:
                 self.logger.info("API not called - in safe mode")
             return None
+
+    def __fetch(self, ourl, verbose=True, codes=None, display=False, page_size=None):
+        '''
+        GET every cursor page of ourl, the full URL already normalized by
+        get(), and return them merged into one result
+        '''
+        firstLoop = True
+        cursor=None
+        result={}
+
+        while firstLoop or cursor:
+            firstLoop = False
+            url = self.__pageUrl(ourl, cursor, page_size)
+            r = self.__getPage(url, verbose=verbose, codes=codes)
+            payload = json.loads(r.text)
+            if "results" in result.keys():
+                result["results"].extend(payload["results"])
+            else:
+                result = payload
+            if "cursor" not in payload:
+                return result
+            else:
+                cursor=payload["cursor"]
+
+            if verbose:
+                self.logger.info("result code: %d" % r.status_code)
         if display:
             self.jsonPrint(json.loads(r.text))
 
         return result
 
+    def iterResults(self, api, verbose=True, codes=None, page_size=None, prefetch=True):
+        '''
+        Generator over the "results" of a cursor paged GET request, yielding
+        one record at a time so callers don't hold every page in memory.
+        api - REST API, this will be appended to self.server
+        page_size - if set, number of results requested per cursor page
+        prefetch - if True, the next page is fetched on a background thread
+                   while the caller processes the current one
+        '''
+        api=self.normalizeGmLmApi(api)
+        ourl = self.server+api
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            r = self.__getPage(self.__pageUrl(ourl, None, page_size),
+                               verbose=verbose, codes=codes)
+            while True:
+                payload = r.json()
+                cursor = payload.get("cursor")
+                future = None
+                if cursor and prefetch:
+                    future = pool.submit(self.__getPage,
+                                         self.__pageUrl(ourl, cursor, page_size),
+                                         verbose=verbose, codes=codes)
+                results = payload.get("results", [])
+                # drop our reference so the page can be freed as it's consumed
+                payload = None
+                for record in results:
+                    yield record
+                if not cursor:
+                    return
+                if future:
+                    r = future.result()
+                else:
+                    r = self.__getPage(self.__pageUrl(ourl, cursor, page_size),
+                                       verbose=verbose, codes=codes)
+
     def patch(self, api, data=None, verbose=True,trial=False, codes=None):
         '''
         REST API patch request.  Note that this does not
@@ -285,18 +632,7 @@ class NsxConnect(requests.Request):
             self.logger.info("API: PATCH %s with data:" %url)
             self.logger.info(json.dumps(data, indent=4))
         if not trial:
-            r = self.session.patch(url,data=json.dumps(data),
-                                   timeout=self.timeout,
-                                   **self.requestAttr)
-            throttle=1
-            while self.__checkApiLimit(r):
-                self.logger.info("API Limit exceeded, sleeping %s seconds and retrying"
-                                 % throttle)
-                time.sleep(throttle)
-                r = self.session.patch(url,data=json.dumps(data),
-                                       timeout=self.timeout,
-                                       **self.requestAttr)
-                throttle+=1
+            r = self.__request("PATCH", url, data=json.dumps(data))
             if verbose:
                 self.logger.info('result code: %d' %r.status_code)
                 if r.text:
@@ -327,22 +663,11 @@ class NsxConnect(requests.Request):
             self.logger.info(json.dumps(data, indent=4))
 
         if not trial:
-            r = self.session.put(url, data=json.dumps(data),
-                                 timeout=self.timeout,
-                                 **self.requestAttr)
-            throttle=1
-            while self.__checkApiLimit(r):
-                self.logger.info("API Limit exceeded, sleeping %s seconds and retrying"
-                                 % throttle)
-                time.sleep(throttle)
-                r = self.session.put(url, data=json.dumps(data),
-                                     timeout=self.timeout,
-                                     **self.requestAttr)
-                throttle+=1
+            r = self.__request("PUT", url, data=json.dumps(data))
             self.__checkReturnCode(r, codes)
             if verbose:
                 self.logger.info('result code: %d' %r.status_code)
-                return json.loads(r.text)
+            return r
         else:
             if verbose:
                 self.logger.info("API not called - in safe mode")
@@ -361,18 +686,7 @@ class NsxConnect(requests.Request):
         if verbose:
             self.logger.info("API: DELETE %s" %url)
         if not trial:
-            r = self.session.delete(url,timeout=self.timeout,
-                                    data=json.dumps(data), 
-                                    **self.requestAttr)
-            throttle=1
-            while self.__checkApiLimit(r):
-                self.logger.info("API Limit exceeded, sleeping %s seconds and retrying"
-                                 % throttle)
-                time.sleep(throttle)
-                r = self.session.delete(url,timeout=self.timeout,
-                                        data=json.dumps(data), 
-                                        **self.requestAttr)
-                throttle+=1
+            r = self.__request("DELETE", url, data=json.dumps(data))
             self.__checkReturnCode(r,codes)
             if verbose:
                 self.logger.info('result code: %d' %r.status_code)
@@ -400,18 +714,7 @@ class NsxConnect(requests.Request):
             self.logger.info("API: POST %s with data" %url)
             self.logger.info(json.dumps(data, indent=4)) 
         if not trial:
-            r = self.session.post(url, data=json.dumps(data),
-                                  timeout=self.timeout,
-                                  **self.requestAttr)
-            throttle=1
-            while self.__checkApiLimit(r):
-                self.logger.info("API Limit exceeded, sleeping %s seconds and retrying"
-                                 % throttle)
-                time.sleep(throttle)
-                r = self.session.post(url, data=json.dumps(data),
-                                      timeout=self.timeout,
-                                      **self.requestAttr)
-                throttle+=1
+            r = self.__request("POST", url, data=json.dumps(data))
             self.__checkReturnCode(r, codes)
             if verbose:
                 self.logger.info('result code: %d' %r.status_code)
@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+import re
+import json
+
+
+class PlanReader():
+    def __init__(self, filename, chunksize=1<<20):
+        '''
+        Incremental reader for the JSON plan written by grouptag.py.  Each
+        pass over the file decodes one array element at a time, values
+        that are not asked for are skipped without being decoded, so memory
+        is bounded by the largest single element rather than the file.
+        filename - plan file
+        chunksize - bytes read from the file at a time
+        '''
+        self.filename = filename
+        self.chunksize = chunksize
+
+    def array(self, key):
+        '''
+        Re-iterable view of top level array key, each iteration is a new
+        pass over the file
+        '''
+        return PlanArray(self, key)
+
+    def items(self, key):
+        '''
+        Generator over the elements of top level array key
+        '''
+        with open(self.filename, "r") as fp:
+            p = PlanParser(fp, self.filename, self.chunksize)
+            for k in p.keys():
+                if k == key:
+                    yield from p.elements()
+                    return
+                p.skip()
+
+    def scopeTags(self, listname):
+        '''
+        Generator of (scope index, tag index, tag) over the listname
+        ("tags" or "tagsremove") array of every entry in scopes
+        '''
+        with open(self.filename, "r") as fp:
+            p = PlanParser(fp, self.filename, self.chunksize)
+            for k in p.keys():
+                if k != "scopes":
+                    p.skip()
+                    continue
+                p.expect("[")
+                s = 0
+                while p.more("]"):
+                    p.expect("{")
+                    for sk in p.members():
+                        if sk == listname:
+                            for t, tag in enumerate(p.elements()):
+                                yield s, t, tag
+                        else:
+                            p.skip()
+                    s+=1
+                return
+
+
+class PlanArray():
+    def __init__(self, reader, key):
+        self.reader = reader
+        self.key = key
+
+    def __iter__(self):
+        return self.reader.items(self.key)
+
+
+class PlanParser():
+    # next character that changes nesting while skipping a value
+    structural = re.compile(r'[\[\]{}"]')
+    string = re.compile(r'"(?:[^"\\]|\\.)*"', re.DOTALL)
+    decoder = json.JSONDecoder()
+
+    def __init__(self, fp, filename, chunksize):
+        '''
+        State of one pass over a plan file, positioned inside the top
+        level object
+        '''
+        self.fp = fp
+        self.filename = filename
+        self.chunksize = chunksize
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+        self.expect("{")
+
+    def fill(self, size=None):
+        '''
+        Read the next chunk, dropping what has been consumed.  False at EOF
+        '''
+        if self.eof:
+            return False
+        data = self.fp.read(size if size else self.chunksize)
+        if not data:
+            self.eof = True
+            return False
+        self.buf = self.buf[self.pos:] + data
+        self.pos = 0
+        return True
+
+    def ws(self):
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in " \t\r\n":
+                self.pos+=1
+            if self.pos < len(self.buf) or not self.fill():
+                return
+
+    def peek(self):
+        self.ws()
+        if self.pos >= len(self.buf):
+            raise ValueError("%s: unexpected end of plan" % self.filename)
+        return self.buf[self.pos]
+
+    def expect(self, ch):
+        if self.peek() != ch:
+            raise ValueError("%s: expected '%s' at '%s'"
+                             %(self.filename, ch, self.buf[self.pos:self.pos+40]))
+        self.pos+=1
+
+    def more(self, close):
+        '''
+        True if the array or object has another member, consuming the comma
+        before it or the closing bracket after the last one
+        '''
+        ch = self.peek()
+        if ch == close:
+            self.pos+=1
+            return False
+        if ch == ",":
+            self.pos+=1
+        return True
+
+    def value(self):
+        '''
+        Decode the next value, reading more of the file until it is complete
+        '''
+        self.ws()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+                # a number cut by the end of the buffer decodes as a shorter
+                # number, it is complete only if something other than a
+                # digit, sign, dot or exponent follows it
+                if (self.eof or not isinstance(value, (int, float)) or
+                    (end < len(self.buf) and self.buf[end] not in "0123456789.eE+-")):
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            # read at least as much again as is buffered, so a large value
+            # is decoded a logarithmic number of times
+            self.fill(max(self.chunksize, len(self.buf) - self.pos))
+
+    def members(self):
+        '''
+        Generator over the keys of the object being read, the caller must
+        read or skip each key's value before asking for the next one
+        '''
+        while self.more("}"):
+            key = self.value()
+            self.expect(":")
+            yield key
+
+    def keys(self):
+        return self.members()
+
+    def elements(self):
+        self.expect("[")
+        while self.more("]"):
+            yield self.value()
+
+    def skip(self):
+        '''
+        Move past the next value without decoding it
+        '''
+        if self.peek() not in "[{":
+            self.value()
+            return
+        depth = 0
+        while True:
+            m = self.structural.search(self.buf, self.pos)
+            if not m:
+                self.pos = len(self.buf)
+                if not self.fill():
+                    raise ValueError("%s: unexpected end of plan" % self.filename)
+                continue
+            if m.group() == '"':
+                s = self.string.match(self.buf, m.start())
+                if not s:
+                    # string continues in the next chunk
+                    self.pos = m.start()
+                    if not self.fill():
+                        raise ValueError("%s: unexpected end of plan" % self.filename)
+                    continue
+                self.pos = s.end()
+                continue
+            self.pos = m.end()
+            if m.group() in "[{":
+                depth+=1
+            else:
+                depth-=1
+                if depth == 0:
+                    return
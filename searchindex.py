@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+import re
+import threading
+from urllib.parse import quote
+from concurrent.futures import ThreadPoolExecutor
+from vmindex import NameIndex, VmRecord
+
+
+# characters with a meaning in the search query syntax
+searchSpecial = re.compile(r'([+\-&|!(){}\[\]^"~*?:\\/ ])')
+
+def searchEscape(value):
+    return searchSpecial.sub(r'\\\1', value)
+
+
+class SearchVmIndex():
+    def __init__(self, nsx, logger, workers=6, batch=100, page_size=None):
+        '''
+        VmIndex answered with targeted search queries instead of the full
+        VM and VIF inventory, for CSVs with few rows to resolve.  Each
+        query returns candidates, which are matched again with NameIndex so
+        rows resolve exactly as against the full inventory.  VMs are
+        returned in search result order.
+        workers - queries sent concurrently by prefetch(),
+                  getByAttachments() and getSegmentPorts()
+        batch - ids ORed into one query
+        IP addresses can't be searched as ranges, rows that resolve IPs
+        need the full inventory.
+        '''
+        self.nsx = nsx
+        self.logger = logger
+        self.workers = workers
+        self.batch = batch
+        self.page_size = page_size
+        self.lock = threading.Lock()
+        self.names = {}
+        self.byAttachment = {}
+        self.ports = {}
+        self.queries = 0
+        self.attached = []
+
+    def __search(self, query):
+        with self.lock:
+            self.queries+=1
+        return list(self.nsx.iterResults(api="/policy/api/v1/search/query?query=%s"
+                                         % quote(query, safe=":*()"),
+                                         codes=[200], verbose=False, page_size=self.page_size))
+
+    @staticmethod
+    def __pattern(name, matchtype):
+        name = searchEscape(name)
+        if matchtype == "startswith":
+            return name + "*"
+        elif matchtype == "endswith":
+            return "*" + name
+        elif matchtype == "contains":
+            return "*" + name + "*"
+        return name
+
+    def __lookup(self, name, matchtype):
+        '''
+        Candidates for one CSV name, read once per name and match type
+        '''
+        if matchtype not in ["startswith", "endswith", "contains"]:
+            matchtype = "match"
+        key = (name.lower(), matchtype)
+        with self.lock:
+            if key in self.names:
+                return self.names[key]
+        vms = [VmRecord.fromVm(vm) for vm in
+               self.__search("resource_type:VirtualMachine AND display_name:%s"
+                             % self.__pattern(name, matchtype))]
+        index = NameIndex(vms)
+        if matchtype == "startswith":
+            found = index.startsWith(name)
+        elif matchtype == "endswith":
+            found = index.endsWith(name)
+        elif matchtype == "contains":
+            found = index.contains(name)
+        else:
+            found = index.findOne(name)
+        with self.lock:
+            self.names[key] = found
+        return found
+
+    def prefetch(self, names):
+        '''
+        Run the searches for a list of (name, matchtype) concurrently,
+        names and match types as in the CSV
+        '''
+        names = set((name.strip(), matchtype.strip().lower()) for name, matchtype in names)
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            for future in [pool.submit(self.__lookup, name, matchtype) for name, matchtype in names]:
+                future.result()
+
+    def nameIndex(self):
+        return self
+
+    def ipIndex(self):
+        self.logger.log(self.logger.ERROR, "IP addresses can only be resolved with the full inventory")
+
+    def findOne(self, name):
+        return self.__lookup(name, "match")
+
+    def startsWith(self, name):
+        return self.__lookup(name, "startswith")
+
+    def endsWith(self, name):
+        return self.__lookup(name, "endswith")
+
+    def contains(self, name):
+        return self.__lookup(name, "contains")
+
+    def __batches(self, ids, fn):
+        # fn for each batch of ids, concurrently
+        batches = [ids[i:i+self.batch] for i in range(0, len(ids), self.batch)]
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            for future in [pool.submit(fn, set(b)) for b in batches]:
+                future.result()
+
+    def __portBatch(self, paths):
+        ports = {}
+        for port in self.__search("resource_type:SegmentPort AND parent_path:(%s)"
+                                  % " OR ".join(searchEscape(p) for p in paths)):
+            if port.get("parent_path") in paths:
+                ports.setdefault(port["parent_path"], []).append(port)
+        with self.lock:
+            for path in paths:
+                self.ports[path] = ports.get(path, [])
+
+    def getSegmentPorts(self, paths):
+        '''
+        Segment path to ports map for the segments in paths, searched for
+        in batches instead of reading every segment port
+        '''
+        with self.lock:
+            missing = list(dict.fromkeys(p for p in paths if p not in self.ports))
+        self.__batches(missing, self.__portBatch)
+        with self.lock:
+            return {path: self.ports[path] for path in paths}
+
+    def __attachmentBatch(self, ids):
+        # VIFs by attachment id, then their owner VMs by external_id
+        vifs = self.__search("resource_type:VirtualNetworkInterface AND lport_attachment_id:(%s)"
+                             % " OR ".join(searchEscape(i) for i in ids))
+        owners = {}
+        for vif in vifs:
+            if vif.get("lport_attachment_id") in ids and vif["owner_vm_id"] not in owners:
+                owners[vif["owner_vm_id"]] = None
+        if owners:
+            for vm in self.__search("resource_type:VirtualMachine AND external_id:(%s)"
+                                    % " OR ".join(searchEscape(i) for i in owners)):
+                if vm["external_id"] in owners and not owners[vm["external_id"]]:
+                    owners[vm["external_id"]] = VmRecord.fromVm(vm)
+        found = {}
+        for vif in vifs:
+            vm = owners.get(vif["owner_vm_id"])
+            if vm and vif.get("lport_attachment_id") in ids and vif["lport_attachment_id"] not in found:
+                found[vif["lport_attachment_id"]] = vm
+        with self.lock:
+            for i in ids:
+                self.byAttachment[i] = found.get(i)
+
+    def getByAttachments(self, ids):
+        '''
+        VMs attached with each id, None where there isn't one, looked up
+        in concurrent batches of ids
+        '''
+        with self.lock:
+            missing = list(dict.fromkeys(i for i in ids if i not in self.byAttachment))
+        self.__batches(missing, self.__attachmentBatch)
+        with self.lock:
+            return [self.byAttachment[i] for i in ids]
+
+    def getByAttachment(self, attachment_id):
+        return self.getByAttachments([attachment_id])[0]
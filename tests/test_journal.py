@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from logger import Logger
+from journal import Journal
+from applyengine import ApplyEngine
+from grouptagapply import applyGroup, applyVMTags
+
+
+class Response():
+    def __init__(self, status_code):
+        self.status_code = status_code
+        self.text = "{}"
+
+
+class Crash(Exception):
+    pass
+
+
+class FakeNsx():
+    def __init__(self, logger, crashAt=None):
+        '''
+        Records the body of every PATCH and PUT, raising Crash instead of
+        sending call number crashAt to stop a run part way
+        '''
+        self.logger = logger
+        self.crashAt = crashAt
+        self.sent = []
+
+    def __send(self, api, data):
+        if self.crashAt is not None and len(self.sent) + 1 == self.crashAt:
+            raise Crash()
+        self.sent.append((api, data))
+        return Response(200)
+
+    def patch(self, api, data, verbose=True, codes=None, trial=False):
+        return self.__send(api, data)
+
+    def put(self, api, data, verbose=True, codes=None, trial=False):
+        return self.__send(api, data)
+
+    def getThrottleStats(self):
+        return {"throttled": 0}
+
+
+def group(name, description=""):
+    return {"url": "/policy/api/v1/infra/domains/default/groups/%s" % name,
+            "method": "patch", "display_name": name,
+            "payload": {"display_name": name, "description": description, "expressions": []}}
+
+
+class JournalTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.logger = Logger(os.path.join(self.dir, "log.txt"))
+        self.plan = os.path.join(self.dir, "plan.json")
+        self.journalFile = self.plan + ".journal"
+        with open(self.plan, "w") as fp:
+            json.dump({"groups": []}, fp)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def journal(self, resume):
+        return Journal(self.journalFile, self.logger, resume=resume, plan=self.plan)
+
+    def applyGroups(self, groups, resume, crashAt=None):
+        nsx = FakeNsx(self.logger, crashAt=crashAt)
+        journal = self.journal(resume)
+        try:
+            applyGroup(nsx, groups, False, None, engine=ApplyEngine(self.logger),
+                       journal=journal)
+        except Crash:
+            pass
+        finally:
+            journal.close()
+        return nsx.sent
+
+    def test_resume_after_partial_run(self):
+        groups = [group("g%d" % i) for i in range(5)]
+        first = self.applyGroups(groups, False, crashAt=3)
+        self.assertEqual([g["url"] for g in groups[:2]], [api for api, data in first])
+        second = self.applyGroups(groups, True)
+        self.assertEqual([g["url"] for g in groups[2:]], [api for api, data in second])
+
+    def test_repeated_url_each_occurrence_resumed(self):
+        groups = [group("a", "first"), group("b"), group("a", "second")]
+        first = self.applyGroups(groups, False, crashAt=3)
+        self.assertEqual(["first", ""], [data["description"] for api, data in first])
+        second = self.applyGroups(groups, True)
+        self.assertEqual([(groups[2]["url"], "second")],
+                         [(api, data["description"]) for api, data in second])
+
+    def test_repeated_url_sent_twice_in_one_run(self):
+        groups = [group("a", "first"), group("a", "second")]
+        sent = self.applyGroups(groups, False)
+        self.assertEqual(["first", "second"], [data["description"] for api, data in sent])
+
+    def test_truncated_last_line_dropped(self):
+        journal = self.journal(False)
+        journal.record("group 0 /a")
+        journal.close()
+        with open(self.journalFile, "a") as fp:
+            fp.write("tag-apply 1 2 30 4")
+        journal = self.journal(True)
+        self.assertEqual(frozenset(["group 0 /a"]), journal.completed)
+        journal.record("group 1 /b")
+        journal.close()
+        with open(self.journalFile) as fp:
+            lines = fp.read().split("\n")
+        self.assertEqual(["group 0 /a", "group 1 /b", ""], lines[1:])
+        self.assertEqual(frozenset(["group 0 /a", "group 1 /b"]), self.journal(True).completed)
+
+    def test_changed_plan_starts_over(self):
+        journal = self.journal(False)
+        journal.record("group 0 /a")
+        journal.close()
+        self.assertEqual(frozenset(["group 0 /a"]), self.journal(True).completed)
+        with open(self.plan, "w") as fp:
+            json.dump({"groups": [group("a")]}, fp)
+        journal = self.journal(True)
+        self.assertEqual(frozenset(), journal.completed)
+        journal.close()
+        with open(self.journalFile) as fp:
+            self.assertEqual(1, len(fp.readlines()))
+
+    def test_copied_plan_resumes(self):
+        journal = self.journal(False)
+        journal.record("group 0 /a")
+        journal.close()
+        os.utime(self.plan, (0, 0))
+        self.assertEqual(frozenset(["group 0 /a"]), self.journal(True).completed)
+
+    def test_tag_chunks_resume_by_offset(self):
+        ids = ["vm-%d" % i for i in range(10)]
+        scopes = [{"tags": [{"tag": {"scope": "App", "tag": "web"},
+                             "apply_to": [{"resource_type": "VirtualMachine",
+                                           "resource_ids": ids}]}]}]
+        sent = []
+        for resume, crashAt in [(False, 3), (True, None)]:
+            nsx = FakeNsx(self.logger, crashAt=crashAt)
+            journal = self.journal(resume)
+            try:
+                applyVMTags(nsx, scopes, False, None, pagesize=3,
+                            engine=ApplyEngine(self.logger), journal=journal)
+            except Crash:
+                pass
+            finally:
+                journal.close()
+            sent.extend(data["apply_to"][0]["resource_ids"] for api, data in nsx.sent)
+        self.assertEqual(ids, [i for chunk in sent for i in chunk])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,314 @@
+#!/usr/bin/env python3
+import bisect
+import ipaddress
+
+
+def ipBounds(ip):
+    '''
+    ip - one entry of the list from grouptag.validateIP
+    Returns (version, first, last), the integer range of addresses it
+    matches, or None for an unknown type
+    '''
+    if ip["type"] == "RANGE":
+        return ip["first"].version, int(ip["first"]), int(ip["second"])
+    elif ip["type"] == "CIDR":
+        # same addresses as cidr.hosts(): networks with more than two
+        # addresses exclude the network address, and for IPv4 the broadcast
+        cidr = ip["cidr"]
+        first = int(cidr.network_address)
+        last = int(cidr.broadcast_address)
+        if cidr.num_addresses > 2:
+            first+=1
+            if cidr.version == 4:
+                last-=1
+        return cidr.version, first, last
+    elif ip["type"] == "IP":
+        return ip["ip"].version, int(ip["ip"]), int(ip["ip"])
+    return None
+
+
+def parseAddresses(vif, logger=None):
+    '''
+    Non-loopback addresses of a VIF's ip_address_info as a tuple of
+    (version, integer value).  Invalid addresses are logged and left out
+    '''
+    found = []
+    for addrinfo in vif.get("ip_address_info", []):
+        if not "ip_addresses" in addrinfo:
+            break
+        for addr in addrinfo["ip_addresses"]:
+            try:
+                ip = ipaddress.ip_address(addr)
+            except ValueError as e:
+                if logger:
+                    logger.log(logger.WARN, "VM %s has invalid address: %s"
+                               %(vif["owner_vm_id"], e))
+                continue
+            if ip.is_loopback:
+                continue
+            found.append((ip.version, int(ip)))
+    return tuple(found)
+
+
+class VmRecord():
+    # the fields resolution reads, a realized VM carries many more
+    __slots__ = ("external_id", "display_name", "lower", "tags", "attachments")
+
+    # equal tags of different VMs share one dict, most VMs carry the same few
+    tagCache = {}
+
+    def __init__(self, external_id, display_name, tags=None):
+        self.external_id = external_id
+        self.display_name = display_name
+        lower = display_name.lower()
+        # share the string when the name is already lowercase
+        self.lower = display_name if lower == display_name else lower
+        self.tags = tags if tags is not None else []
+        # list of VifRecord, None until a VIF is associated
+        self.attachments = None
+
+    @classmethod
+    def fromVm(cls, vm):
+        '''
+        Project a VM from realized-state/virtual-machines, or from toDict()
+        '''
+        tags = []
+        for tag in vm.get("tags", []):
+            key = tuple(sorted(tag.items()))
+            if key not in cls.tagCache:
+                cls.tagCache[key] = tag
+            tags.append(cls.tagCache[key])
+        return cls(vm["external_id"], vm["display_name"], tags)
+
+    def toDict(self):
+        return {"external_id": self.external_id, "display_name": self.display_name,
+                "tags": self.tags}
+
+
+class VifRecord():
+    __slots__ = ("external_id", "owner_vm_id", "lport_attachment_id", "addresses")
+
+    def __init__(self, external_id, owner_vm_id, lport_attachment_id, addresses):
+        self.external_id = external_id
+        self.owner_vm_id = owner_vm_id
+        self.lport_attachment_id = lport_attachment_id
+        self.addresses = addresses
+
+    @classmethod
+    def fromVif(cls, vif, logger=None):
+        '''
+        Project a VIF from fabric/vifs, or from toDict(), parsing its addresses
+        '''
+        return cls(vif.get("external_id"), vif["owner_vm_id"], vif.get("lport_attachment_id"),
+                   parseAddresses(vif, logger))
+
+    def toDict(self):
+        vif = {"external_id": self.external_id, "owner_vm_id": self.owner_vm_id,
+               "ip_address_info": [{"ip_addresses": [str(ipaddress.ip_address(a[1]))
+                                                     for a in self.addresses]}]}
+        if self.lport_attachment_id is not None:
+            vif["lport_attachment_id"] = self.lport_attachment_id
+        return vif
+
+
+class VmIndex():
+    def __init__(self, vms, logger):
+        '''
+        Indexes over the realized VM inventory.  These are built once per run
+        so that each CSV row doesn't have to rescan the whole VM list.
+        vms - list of VmRecord
+        '''
+        self.vms = vms
+        self.logger = logger
+        self.byId = {}
+        self.byAttachment = {}
+        self.names = None
+        self.ips = None
+        self.attached = [vm for vm in vms if vm.attachments is not None]
+        for vm in vms:
+            # keep the first VM if an external_id is ever duplicated, same as
+            # the old linear scan did
+            if vm.external_id not in self.byId:
+                self.byId[vm.external_id] = vm
+        self.__indexAttachments()
+
+    def associateVifs(self, vifs, progress=True):
+        '''
+        Attach each VifRecord to its owning VM in a single pass over vifs.
+        VIFs whose owner VM is not in the inventory are reported once,
+        in bulk, at the end
+        '''
+        if progress:
+            self.logger.log(self.logger.INFO, "Associating %d VIFs to %d VMs"
+                            %(len(vifs), len(self.vms)))
+        orphans = []
+        for vif in vifs:
+            vm = self.byId.get(vif.owner_vm_id)
+            if not vm:
+                orphans.append(vif)
+                continue
+            if vm.attachments is not None:
+                vm.attachments.append(vif)
+            else:
+                vm.attachments = [vif]
+
+        # inventory order is preserved so resolvers return VMs in the same
+        # order as a scan of the full VM list would
+        self.attached = [vm for vm in self.vms if vm.attachments is not None]
+        self.__indexAttachments()
+        if orphans:
+            shown = ["%s (VM %s)" %(v.external_id, v.owner_vm_id)
+                     for v in orphans[:100]]
+            if len(orphans) > len(shown):
+                shown.append("...")
+            self.logger.log(self.logger.WARN, "%d VIFs have no matching VM: %s"
+                            %(len(orphans), ", ".join(shown)))
+        if progress:
+            self.logger.log(self.logger.INFO, "Associated %d VIFs, %d VMs have attachments"
+                            %(len(vifs) - len(orphans), len(self.attached)))
+        return orphans
+
+    def __indexAttachments(self):
+        # lport_attachment_id to VM, first VM in inventory order wins
+        self.byAttachment = {}
+        for vm in self.attached:
+            for a in vm.attachments:
+                if a.lport_attachment_id is None:
+                    continue
+                if a.lport_attachment_id not in self.byAttachment:
+                    self.byAttachment[a.lport_attachment_id] = vm
+
+    def get(self, external_id):
+        return self.byId.get(external_id)
+
+    def getByAttachment(self, attachment_id):
+        return self.byAttachment.get(attachment_id)
+
+    def getByAttachments(self, ids):
+        return [self.byAttachment.get(i) for i in ids]
+
+    def nameIndex(self):
+        '''
+        Returns the NameIndex for all VMs, building it on first use
+        '''
+        if not self.names:
+            self.names = NameIndex(self.vms)
+        return self.names
+
+    def ipIndex(self):
+        '''
+        Returns the IpIndex for VMs with attachments, building it on first use
+        '''
+        if not self.ips:
+            self.ips = IpIndex(self.attached, self.logger)
+        return self.ips
+
+
+class NameIndex():
+    def __init__(self, vms, gramsize=3):
+        '''
+        Case insensitive display_name indexes.  All lookups return VMs in
+        the order they appear in vms, same as a linear scan would.
+        exact - lowercase name to position of the VM with that name and
+                the lowest external_id, the first one if that's repeated
+        prefixes - sorted lowercase names, searched with bisect
+        suffixes - sorted reversed lowercase names, searched with bisect
+        grams - n-gram to ascending list of VM positions, for contains
+        '''
+        self.vms = vms
+        self.gramsize = gramsize
+        self.lower = [vm.lower for vm in vms]
+        self.exact = {}
+        self.grams = {}
+        for pos, name in enumerate(self.lower):
+            if name not in self.exact or vms[pos].external_id < vms[self.exact[name]].external_id:
+                self.exact[name] = pos
+            for gram in set(name[i:i+gramsize] for i in range(len(name)-gramsize+1)):
+                if gram in self.grams:
+                    self.grams[gram].append(pos)
+                else:
+                    self.grams[gram] = [pos]
+        ordered = sorted((name, pos) for pos, name in enumerate(self.lower))
+        self.prefixes = [i[0] for i in ordered]
+        self.prefixPos = [i[1] for i in ordered]
+        ordered = sorted((name[::-1], pos) for pos, name in enumerate(self.lower))
+        self.suffixes = [i[0] for i in ordered]
+        self.suffixPos = [i[1] for i in ordered]
+
+    def __sortedRange(self, keys, positions, prefix):
+        found = []
+        i = bisect.bisect_left(keys, prefix)
+        while i < len(keys) and keys[i].startswith(prefix):
+            found.append(positions[i])
+            i+=1
+        return [self.vms[pos] for pos in sorted(found)]
+
+    def findOne(self, name):
+        pos = self.exact.get(name.lower())
+        if pos is None:
+            return []
+        return [self.vms[pos]]
+
+    def startsWith(self, name):
+        return self.__sortedRange(self.prefixes, self.prefixPos, name.lower())
+
+    def endsWith(self, name):
+        return self.__sortedRange(self.suffixes, self.suffixPos, name.lower()[::-1])
+
+    def contains(self, name):
+        name = name.lower()
+        if len(name) < self.gramsize:
+            # too short to have an n-gram, scan the pre-lowered names
+            return [self.vms[pos] for pos, n in enumerate(self.lower) if name in n]
+        # every match must contain all of the name's n-grams, so the
+        # shortest posting list is a complete candidate list
+        candidates = None
+        for i in range(len(name)-self.gramsize+1):
+            posting = self.grams.get(name[i:i+self.gramsize])
+            if not posting:
+                return []
+            if candidates is None or len(posting) < len(candidates):
+                candidates = posting
+        return [self.vms[pos] for pos in candidates if name in self.lower[pos]]
+
+
+class IpIndex():
+    def __init__(self, vms, logger):
+        '''
+        Sorted integer values of every non-loopback VIF address, one array
+        per IP version, with a parallel array of VM positions in vms
+        '''
+        self.vms = vms
+        entries = {4: [], 6: []}
+        for pos, vm in enumerate(vms):
+            if vm.attachments is None:
+                continue
+            for vif in vm.attachments:
+                for version, value in vif.addresses:
+                    entries[version].append((value, pos))
+        self.keys = {}
+        self.positions = {}
+        for version in entries:
+            entries[version].sort()
+            self.keys[version] = [i[0] for i in entries[version]]
+            self.positions[version] = [i[1] for i in entries[version]]
+
+    def findRange(self, version, first, last):
+        '''
+        Return VMs with any address between integers first and last inclusive,
+        each VM once and in the order of vms
+        '''
+        keys = self.keys[version]
+        lo = bisect.bisect_left(keys, first)
+        hi = bisect.bisect_right(keys, last)
+        found = sorted(set(self.positions[version][lo:hi]))
+        return [self.vms[pos] for pos in found]
+
+    def find(self, ip):
+        '''
+        ip - one entry of the list from grouptag.validateIP
+        '''
+        bounds = ipBounds(ip)
+        if not bounds:
+            return []
+        return self.findRange(*bounds)